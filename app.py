@@ -1,13 +1,25 @@
 import streamlit as st
-import fitz  # PyMuPDF
-import io
-import zipfile
-import requests
-import qrcode
-from PIL import Image
-from openpyxl import load_workbook
-import numpy as np
-import re
+import os
+import json
+from functools import partial
+
+from core import (
+    RESULT_EXPIRED,
+    TEXT_LINK_TYPES,
+    cancel_job,
+    extract_link_rows_from_excel,
+    extract_link_rows_from_text_file,
+    find_job_entry,
+    forget_job,
+    index_links,
+    job_file_url,
+    job_result_url,
+    job_status,
+    read_result_bytes,
+    read_zip_entry,
+    start_results_server,
+    submit_campaign,
+)
 
 # --- КОНФИГУРАЦИЯ СТРАНИЦЫ ---
 st.set_page_config(
@@ -209,318 +221,96 @@ st.markdown(
 """,
     unsafe_allow_html=True,
 )
+# --- ОТЧЁТ О ПРОГОНЕ ---
+STAGE_LABELS = {
+    "detect": "Поиск места под QR",
+    "qr_plan": "План версии QR",
+    "cache_lookup": "Кэш QR",
+    "fetch": "Загрузка по ссылкам",
+    "qr_encode": "Кодирование QR",
+    "pdf_open": "Копия макета",
+    "insert_qr": "Вставка QR",
+    "tobytes": "Сохранение PDF",
+    "zip_write": "Запись в архив",
+}
+
+
+def show_run_report(report):
+    with st.expander("Отчёт о скорости", expanded=False):
+        counters = report.get("counters", {})
+        st.caption(
+            f"Всего {report['wall_s']:.2f} с · ссылок {counters.get('links', 0)}, "
+            f"уникальных {counters.get('unique_links', 0)}, "
+            f"взято из прошлой сборки {counters.get('reused_entries', 0)} · "
+            f"результат {counters.get('output_bytes', 0) / 1024 / 1024:.1f} МБ, "
+            f"оптимизация PDF: {report.get('output_profile') or '—'}"
+        )
+        st.table(
+            [
+                {
+                    "Этап": STAGE_LABELS.get(name, name),
+                    "Вызовов": s["count"],
+                    "Всего, с": round(s["total_s"], 2),
+                    "Макс., с": round(s["max_s"], 3),
+                    "МБ": round(s["bytes"] / 1024 / 1024, 2),
+                }
+                for name, s in report["stages"].items()
+            ]
+        )
+        if report.get("sources"):
+            st.caption(
+                "Источник QR: "
+                + ", ".join(f"{k} {v}" for k, v in report["sources"].items())
+            )
+        if report.get("network"):
+            st.caption(
+                "Сеть: " + ", ".join(f"{k} {v}" for k, v in report["network"].items())
+            )
+        st.download_button(
+            "Отчёт в JSON",
+            json.dumps(report, ensure_ascii=False, indent=1),
+            f"report_{report['started'].replace(':', '-')}.json",
+            "application/json",
+        )
 
-# --- КОНСТАНТЫ ---
-MM_TO_POINT = 72 / 25.4
-HEADERS = {"User-Agent": "Mozilla/5.0"}
-
-
-def mm_to_pt(mm_val: float) -> float:
-    return mm_val * MM_TO_POINT
-
-
-# --- QR-ИЗОБРАЖЕНИЕ ---
-def get_or_generate_qr_image(link: str):
-    if not link or str(link).lower() == "nan":
-        return None
-    link = str(link).strip()
-    if not link:
-        return None
-
-    try:
-        download_url = link
-        if not download_url.startswith("http"):
-            download_url = "https://" + download_url
-        resp = requests.get(download_url, headers=HEADERS, timeout=3)
-        if resp.status_code == 200:
-            pil_img = Image.open(io.BytesIO(resp.content))
-            img_byte_arr = io.BytesIO()
-            pil_img.save(img_byte_arr, format="PNG")
-            return img_byte_arr.getvalue()
-    except Exception:
-        pass
 
+# --- ВЫДАЧА РЕЗУЛЬТАТОВ ---
+# Сервер результатов один на процесс (RESULTS_HTTP_PORT в core): через него
+# файлы идут с диска кусками, минуя память Streamlit, а архив можно начать
+# качать, пока он ещё собирается. Без него остаются download_button.
+@st.cache_resource
+def results_server():
     try:
-        qr = qrcode.QRCode(box_size=10, border=0)
-        qr.add_data(link)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white")
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format="PNG")
-        return img_byte_arr.getvalue()
-    except Exception:
+        return start_results_server()
+    except OSError:
         return None
 
 
-# --- РАСТРОВЫЙ ДЕТЕКТОР БЕЛЫХ ОБЛАСТЕЙ ---
-def _detect_white_rectangles_raster(
-    pdf_bytes: bytes,
-    white_threshold: int = 245,
-    min_area_ratio: float = 0.001,
-    max_area_ratio: float = 0.9,
-):
-    rects_pt = []
-
-    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-        page = doc[0]
-        page_w_pt = page.rect.width
-        page_h_pt = page.rect.height
-
-        pix = page.get_pixmap(alpha=False)
-        img_w, img_h = pix.width, pix.height
-        img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(img_h, img_w, 3)
-
-    gray = img.mean(axis=2)
-    mask = gray > white_threshold
-    visited = np.zeros_like(mask, dtype=bool)
-    img_area = img_w * img_h
-
-    def flood_fill(sx, sy):
-        stack = [(sx, sy)]
-        visited[sy, sx] = True
-        min_x = max_x = sx
-        min_y = max_y = sy
-
-        while stack:
-            x, y = stack.pop()
-
-            if x < min_x:
-                min_x = x
-            if x > max_x:
-                max_x = x
-            if y < min_y:
-                min_y = y
-            if y > max_y:
-                max_y = y
-
-            for nx, ny in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
-                if 0 <= nx < img_w and 0 <= ny < img_h:
-                    if mask[ny, nx] and not visited[ny, nx]:
-                        visited[ny, nx] = True
-                        stack.append((nx, ny))
-
-        return min_x, min_y, max_x, max_y
-
-    for y in range(img_h):
-        for x in range(img_w):
-            if mask[y, x] and not visited[y, x]:
-                x1, y1, x2, y2 = flood_fill(x, y)
-
-                w = x2 - x1 + 1
-                h = y2 - y1 + 1
-                area = w * h
-                area_ratio = area / img_area
-                if area_ratio < min_area_ratio or area_ratio > max_area_ratio:
-                    continue
-
-                aspect = w / h if h != 0 else 0
-                if aspect < 0.5 or aspect > 2.0:
-                    continue
-
-                x_pt = x1 * page_w_pt / img_w
-                y_pt = y1 * page_h_pt / img_h
-                w_pt = w * page_w_pt / img_w
-                h_pt = h * page_h_pt / img_h
-
-                rects_pt.append((x_pt, y_pt, w_pt, h_pt))
-
-    rects_pt.sort(key=lambda r: r[2] * r[3], reverse=True)
-    return rects_pt
-
-
-# --- ДЕТЕКТОР БЕЛЫХ КВАДРАТОВ В PDF ---
-def detect_white_rectangles_in_pdf(pdf_bytes: bytes):
-    rects_pt = []
-
-    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-        page = doc[0]
-        page_rect = page.rect
-        page_w_pt = page_rect.width
-        page_h_pt = page_rect.height
-
-        drawings = page.get_drawings()
-
-        for d in drawings:
-            r = d.get("rect", None)
-            if r is None:
-                continue
-
-            fill = d.get("fill", None)
-            if fill is None:
-                fill = d.get("color", None)
-            if fill is None:
-                continue
-
-            fr, fg, fb = fill
-            if fr < 0.95 or fg < 0.95 or fb < 0.95:
-                continue
-
-            w_pt = r.width
-            h_pt = r.height
-            if w_pt <= 0 or h_pt <= 0:
-                continue
-
-            area = w_pt * h_pt
-            area_ratio = area / (page_w_pt * page_h_pt)
-            if area_ratio < 0.001 or area_ratio > 0.6:
-                continue
-
-            aspect = w_pt / h_pt if h_pt != 0 else 0
-            if aspect < 0.5 or aspect > 2.0:
-                continue
-
-            rects_pt.append((r.x0, r.y0, w_pt, h_pt))
-
-    if rects_pt:
-        rects_pt.sort(key=lambda r: r[2] * r[3], reverse=True)
-        return rects_pt
-
-    return _detect_white_rectangles_raster(pdf_bytes)
-
-
-# --- ОБРАБОТКА PDF И ГЕНЕРАЦИЯ ZIP ---
-def process_files(pdf_file, links, p_name, p_size, mode, x_mm, y_mm, size_mm):
-    zip_buffer = io.BytesIO()
-    pdf_file.seek(0)
-    pdf_bytes = pdf_file.read()
-    success_count = 0
-    errors_log = []
-    total_links = len(links)
-
-    white_rects = []
-    if mode == "white_rect":
-        try:
-            white_rects_raw = detect_white_rectangles_in_pdf(pdf_bytes)
-            min_size_mm = 25.0
-            white_rects = [
-                r for r in white_rects_raw if min(r[2], r[3]) / MM_TO_POINT >= min_size_mm
-            ]
-            if not white_rects:
-                errors_log.append("Белый квадрат не найден или его сторона меньше 25 мм.")
-                return None, errors_log
-        except Exception as e:
-            errors_log.append(f"Автообнаружение: ошибка {e}")
-            return None, errors_log
-
-    my_bar = st.progress(0, text="Начинаем обработку...")
-
-    with zipfile.ZipFile(zip_buffer, "w") as zf:
-        for i, url in enumerate(links, start=1):
-            my_bar.progress(i / total_links, text=f"Обработка {i} из {total_links}")
-            try:
-                filename = f"{p_name}_{p_size}_{i:02d}.pdf"
-                qr_bytes = get_or_generate_qr_image(url)
-
-                if qr_bytes:
-                    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-                        page = doc[0]
-
-                        if mode == "white_rect" and white_rects:
-                            rx, ry, rw, rh = white_rects[0]
-                            margin_pt = mm_to_pt(2.0)
-                            inner_w = rw - 2 * margin_pt
-                            inner_h = rh - 2 * margin_pt
-                            qr_size_pt = min(inner_w, inner_h)
-
-                            if qr_size_pt <= 0:
-                                errors_log.append(
-                                    "Подходящий квадрат найден, но внутренняя область слишком маленькая."
-                                )
-                                return None, errors_log
-
-                            x_pt = rx + margin_pt + (inner_w - qr_size_pt) / 2
-                            y_pt = ry + margin_pt + (inner_h - qr_size_pt) / 2
-                        else:
-                            x_pt = mm_to_pt(x_mm)
-                            y_pt = mm_to_pt(y_mm)
-                            qr_size_pt = mm_to_pt(size_mm)
-
-                        rect = fitz.Rect(
-                            x_pt,
-                            y_pt,
-                            x_pt + qr_size_pt,
-                            y_pt + qr_size_pt,
-                        )
-                        page.insert_image(rect, stream=qr_bytes)
-
-                        pdf_out = doc.tobytes()
-                        zf.writestr(filename, pdf_out)
-                        success_count += 1
-                else:
-                    errors_log.append(
-                        f"Ссылка №{i}: Пустые данные или сбой при создании QR"
-                    )
-            except Exception as e:
-                errors_log.append(f"Ссылка №{i}: Ошибка {e}")
-
-    my_bar.empty()
-    zip_buffer.seek(0)
-
-    if success_count == 0:
-        return None, errors_log
-    return zip_buffer, errors_log
-
-
-# --- ЧТЕНИЕ ССЫЛОК ИЗ EXCEL ---
-def extract_links_from_excel(file) -> list:
-    file_bytes = file.read()
-    bio = io.BytesIO(file_bytes)
-
-    wb = load_workbook(bio, data_only=True)
-    ws = wb.active
-
-    all_columns = []
-    max_col = ws.max_column
-    max_row = ws.max_row
-
-    for col_idx in range(1, max_col + 1):
-        col_values = []
-        for row_idx in range(1, max_row + 1):
-            cell = ws.cell(row=row_idx, column=col_idx)
-
-            if cell.hyperlink and cell.hyperlink.target:
-                text = str(cell.hyperlink.target).strip()
-            else:
-                val = cell.value
-                text = "" if val is None else str(val).strip()
-
-            col_values.append(text)
-        all_columns.append(col_values)
-
-    def is_url_like(s: str) -> bool:
-        s = s.strip()
-        if len(s) <= 5:
-            return False
-        return bool(re.search(r"http|www|\.[a-zA-Z]{2,}", s))
-
-    best_idx = None
-    best_score = 0
-
-    for idx, col_vals in enumerate(all_columns):
-        if not col_vals:
-            continue
-        score = sum(1 for v in col_vals if is_url_like(v))
-        if score > best_score:
-            best_score = score
-            best_idx = idx
-
-    if best_idx is None or best_score == 0:
-        return []
-
-    col_vals = all_columns[best_idx]
-
-    if col_vals and not is_url_like(col_vals[0]):
-        data_vals = col_vals[1:]
+# Отдельный файл архива по номеру ссылки — первые макеты можно проверять,
+# пока собираются остальные.
+def show_ready_file(job, key):
+    st.caption(f"Готово файлов: {len(job['entries'])}")
+    index = st.number_input(
+        "Скачать отдельный файл: номер ссылки", min_value=1, value=1, step=1, key=key
+    )
+    entry = find_job_entry(job, int(index))
+    if entry is None:
+        st.caption("Этот файл ещё не готов.")
+    elif not os.path.exists(job["result_path"]):
+        st.warning(RESULT_EXPIRED)
+    elif results_server() is not None:
+        st.link_button(
+            f"Скачать {entry['name']}", job_file_url(job["id"], entry["index"])
+        )
     else:
-        data_vals = col_vals
-
-    clean_links = [
-        v.strip()
-        for v in data_vals
-        if v and v.strip() and v.strip().lower() not in ("nan", "none")
-    ]
-
-    return clean_links
+        st.download_button(
+            f"Скачать {entry['name']}",
+            partial(read_zip_entry, job["result_path"], entry),
+            entry["name"],
+            "application/pdf",
+            on_click="ignore",
+            key=f"{key}_download",
+        )
 
 
 # --- ВЕРСТКА ---
@@ -577,8 +367,37 @@ QR будет вставлен в найденный на макете белы
             unsafe_allow_html=True,
         )
         x_mm = y_mm = size_mm = 0.0
+
+        with st.expander("Растровый поиск", expanded=False):
+            st.caption(
+                "Используется, если на макете нет векторного белого квадрата. "
+                "В режиме пирамиды области ищутся на грубом растре, а края "
+                "уточняются в высоком разрешении только вокруг найденных областей."
+            )
+            use_pyramid = st.checkbox("Уточнять края (пирамида)", value=False)
+            r1, r2 = st.columns(2)
+            with r1:
+                raster_dpi = st.number_input(
+                    "DPI поиска",
+                    min_value=18,
+                    max_value=300,
+                    value=36 if use_pyramid else 72,
+                    step=6,
+                )
+            with r2:
+                refine_dpi = st.number_input(
+                    "DPI уточнения",
+                    min_value=72,
+                    max_value=1200,
+                    value=300,
+                    step=25,
+                    disabled=not use_pyramid,
+                )
+            if not use_pyramid:
+                refine_dpi = None
     else:
         pos_mode = "manual"
+        raster_dpi, refine_dpi = 72, None
         g1, g2, g3 = st.columns(3)
         with g1:
             x_mm = st.number_input("Отступ слева (мм)", value=20.0)
@@ -587,6 +406,93 @@ QR будет вставлен в найденный на макете белы
         with g3:
             size_mm = st.number_input("Размер QR (мм)", value=20.0)
 
+    page_selection = st.text_input(
+        "Страницы для QR",
+        value="1",
+        help="Номера страниц макета через запятую, диапазоны через дефис "
+        "(«1,3-5») или «все». Белый квадрат ищется на каждой выбранной "
+        "странице один раз на всю партию.",
+    )
+
+    st.markdown("<hr>", unsafe_allow_html=True)
+    st.markdown(
+        '<div class="section-title">Как выгрузить?</div>',
+        unsafe_allow_html=True,
+    )
+    output_label = st.radio(
+        "Формат результата",
+        ["ZIP: отдельный PDF на каждую ссылку", "Один PDF: страница на каждую ссылку"],
+        index=0,
+    )
+    output_mode = "pdf" if output_label.startswith("Один PDF") else "zip"
+    if output_mode == "pdf":
+        st.caption(
+            "Макет хранится в файле один раз, страницы отличаются только QR — "
+            "файл в разы меньше архива. На каждую ссылку — все страницы макета."
+        )
+        zip_compression = 0
+    else:
+        zip_compression = st.slider(
+            "Сжатие архива",
+            min_value=0,
+            max_value=9,
+            value=0,
+            help="0 — без сжатия, быстрее всего. 1–9 — deflate: архив меньше, "
+            "сборка дольше.",
+        )
+
+    output_profile_labels = {
+        "Быстрее всего: PDF как есть": "fast",
+        "Сбалансированно: сжатие без заметных потерь времени": "balanced",
+        "Минимальный размер: для загрузки на порталы типографий": "smallest",
+    }
+    output_profile = output_profile_labels[
+        st.selectbox(
+            "Оптимизация PDF",
+            list(output_profile_labels),
+            index=0,
+            help="Как сохранять каждый PDF. Сжатие и чистка потоков уменьшают "
+            "файлы в разы, но переписывают содержимое страниц макета; "
+            "фотографии, которые уже сжаты, меньше не станут.",
+        )
+    ]
+
+    qr_vector = st.checkbox(
+        "Векторный QR",
+        value=True,
+        help="QR рисуется контурами прямо в PDF: файл меньше, печать чёткая "
+        "при любом размере. Без галочки QR вставляется PNG-картинкой.",
+    )
+    qr_uniform = st.checkbox(
+        "Одинаковый размер QR в партии",
+        value=True,
+        help="Все QR кодируются в одной версии: модули одного размера на "
+        "всех макетах, а коррекция ошибок — максимальная из тех, что "
+        "помещаются без увеличения кода.",
+    )
+    link_policy_labels = {
+        "Авто: картинка по ссылке или новый QR": "auto",
+        "Всегда генерировать QR": "generate",
+        "Только скачивать картинки по ссылкам": "fetch",
+    }
+    link_policy = link_policy_labels[
+        st.selectbox("Что делать со ссылками", list(link_policy_labels), index=0)
+    ]
+    dedupe = st.checkbox(
+        "Одинаковые ссылки собирать один раз",
+        value=True,
+        help="Повторяющаяся ссылка обрабатывается один раз, а готовый файл "
+        "копируется под каждым её номером.",
+    )
+    render_workers = st.number_input(
+        "Процессов для сборки PDF",
+        min_value=1,
+        max_value=os.cpu_count() or 1,
+        value=1,
+        help="Больше одного — файлы архива собираются параллельно на нескольких "
+        "ядрах. В режиме «Один PDF» сборка всегда идёт в одном процессе.",
+    )
+
 # ПРАВАЯ КОЛОНКА
 with col_right:
     st.write("")
@@ -598,8 +504,49 @@ with col_right:
 
     if "links_final" not in st.session_state:
         st.session_state.links_final = []
-
-    tab_manual, tab_excel = st.tabs(["Вручную", "Из excel"])
+        st.session_state.rows_final = []
+        st.session_state.links_by_source = {}
+
+    # Строки каждого источника пересобираются, только когда меняется сам
+    # источник (текст или файл), а не на каждом перезапуске скрипта. Строка —
+    # ссылка и, если в файле есть такие колонки, свой макет и место QR.
+    def load_links(kind, source_key, loader):
+        cached = st.session_state.links_by_source.get(kind)
+        if cached is None or cached[0] != source_key:
+            rows = loader()
+            cached = (source_key, [row["link"] for row in rows], rows)
+            st.session_state.links_by_source[kind] = cached
+        st.session_state.links_final = cached[1]
+        st.session_state.rows_final = cached[2]
+        return cached[1]
+
+    def show_found_links(links):
+        if len(links) > 0:
+            unique_count = len(index_links(links)[0])
+            st.success(f"✅ Найдено ссылок: {len(links)}")
+            if unique_count < len(links):
+                st.caption(f"Из них разных: {unique_count}")
+            placed = sum(len(row) > 1 for row in st.session_state.rows_final)
+            if placed:
+                st.caption(
+                    f"Свой макет или место QR у {placed} строк — из колонок "
+                    "«qr_layout», «qr_x_mm», «qr_y_mm», «qr_size_mm», «qr_pages»."
+                )
+            st.markdown(
+                "<div style='height:8px;'></div>",
+                unsafe_allow_html=True,
+            )
+            with st.expander("Показать найденные ссылки", expanded=False):
+                for i, link in enumerate(links[:200], start=1):
+                    st.write(f"{i}. {link}")
+                if len(links) > 200:
+                    st.caption(f"…и ещё {len(links) - 200}")
+        else:
+            st.warning(
+                "Не удалось найти ссылки в файле. Проверьте, что в колонке есть URL или гиперссылки."
+            )
+
+    tab_manual, tab_excel, tab_text = st.tabs(["Вручную", "Из excel", "Из CSV/TXT"])
 
     with tab_manual:
         st.write("")
@@ -610,9 +557,13 @@ with col_right:
             placeholder="https://",
         )
         if manual_text:
-            st.session_state.links_final = [
-                l.strip() for l in manual_text.split("\n") if l.strip()
-            ]
+            load_links(
+                "manual",
+                manual_text,
+                lambda: [
+                    {"link": l.strip()} for l in manual_text.split("\n") if l.strip()
+                ],
+            )
 
     with tab_excel:
         st.write("")
@@ -622,22 +573,34 @@ with col_right:
         if uploaded_excel:
             try:
                 uploaded_excel.seek(0)
-                links_from_excel = extract_links_from_excel(uploaded_excel)
-                st.session_state.links_final = links_from_excel
-
-                if len(links_from_excel) > 0:
-                    st.success(f"✅ Найдено ссылок: {len(links_from_excel)}")
-                    st.markdown(
-                        "<div style='height:8px;'></div>",
-                        unsafe_allow_html=True,
-                    )
-                    with st.expander("Показать найденные ссылки", expanded=False):
-                        for i, link in enumerate(links_from_excel, start=1):
-                            st.write(f"{i}. {link}")
-                else:
-                    st.warning(
-                        "Не удалось найти ссылки в файле. Проверьте, что в колонке есть URL или гиперссылки."
-                    )
+                links_from_excel = load_links(
+                    "xlsx",
+                    uploaded_excel.file_id,
+                    lambda: extract_link_rows_from_excel(uploaded_excel),
+                )
+                show_found_links(links_from_excel)
+            except Exception as e:
+                st.error(f"Ошибка файла: {e}")
+
+    with tab_text:
+        st.write("")
+        uploaded_text = st.file_uploader(
+            "CSV / TSV / TXT",
+            type=TEXT_LINK_TYPES,
+            key="txt",
+            label_visibility="collapsed",
+        )
+        st.caption("CSV, TSV или TXT (ссылка на строку), можно сжатые .gz")
+        if uploaded_text:
+            try:
+                links_from_text = load_links(
+                    "text",
+                    uploaded_text.file_id,
+                    lambda: extract_link_rows_from_text_file(
+                        uploaded_text, uploaded_text.name
+                    ),
+                )
+                show_found_links(links_from_text)
             except Exception as e:
                 st.error(f"Ошибка файла: {e}")
 
@@ -654,6 +617,15 @@ with col_right:
     uploaded_pdf = st.file_uploader(
         "PDF", type=["pdf"], key="pdf", label_visibility="collapsed"
     )
+    uploaded_variants = st.file_uploader(
+        "Другие варианты макета",
+        type=["pdf"],
+        key="pdf_variants",
+        accept_multiple_files=True,
+        help="Для кампаний с разными форматами: строка списка выбирает "
+        "вариант по имени файла в колонке «qr_layout». Строки без макета идут "
+        "на основной.",
+    )
 
     if "prev_pdf_name" not in st.session_state:
         st.session_state.prev_pdf_name = None
@@ -663,6 +635,10 @@ with col_right:
         st.session_state.prev_pdf_name = current_pdf_name
         st.session_state.zip_result = None
         st.session_state.zip_name = None
+        if st.session_state.get("job_id"):
+            forget_job(st.session_state.job_id)
+            st.session_state.job_id = None
+            st.query_params.pop("job", None)
 
     st.markdown("<br>", unsafe_allow_html=True)
 
@@ -670,7 +646,65 @@ with col_right:
         st.session_state.zip_result = None
         st.session_state.zip_name = None
 
-    if st.session_state.zip_result is None:
+    if "detect_timings" not in st.session_state:
+        st.session_state.detect_timings = {}
+        st.session_state.cache_delta = {}
+        st.session_state.report = None
+
+    if "job_id" not in st.session_state:
+        st.session_state.job_id = st.query_params.get("job")
+        st.session_state.job_name = None
+
+    @st.fragment(run_every=1.0)
+    def show_job_progress(job_id):
+        job = job_status(job_id)
+        if job is None or job["status"] not in ("queued", "running"):
+            st.rerun()
+        st.progress(job["done"] / max(job["total"], 1), text=job["text"])
+        if st.button("Отменить"):
+            cancel_job(job_id)
+        if job["entries"]:
+            if results_server() is not None:
+                st.link_button(
+                    "Скачивать архив по мере готовности",
+                    job_result_url(job_id, st.session_state.job_name or "qrs.zip"),
+                )
+            show_ready_file(job, key="ready_file_running")
+
+    job = job_status(st.session_state.job_id) if st.session_state.job_id else None
+    if st.session_state.job_id and job is None:
+        st.session_state.job_id = None
+        st.query_params.pop("job", None)
+    elif job is not None and job["status"] == "done":
+        # Прошлая сборка нужна, пока новая берёт из неё неизменённые файлы.
+        if st.session_state.get("prev_job_id"):
+            forget_job(st.session_state.prev_job_id)
+            st.session_state.prev_job_id = None
+        if st.session_state.zip_result is not job["result"]:
+            st.session_state.zip_result = job["result"]
+            st.session_state.zip_name = st.session_state.job_name or (
+                "qrs.pdf" if job["result"].name.endswith(".pdf") else "qrs.zip"
+            )
+            st.session_state.detect_timings = job["detect_timings"]
+            st.session_state.cache_delta = job["cache_delta"]
+            st.session_state.report = job["report"]
+    elif job is not None and job["status"] in ("failed", "cancelled"):
+        forget_job(st.session_state.job_id)
+        st.session_state.job_id = None
+        st.query_params.pop("job", None)
+        errs = job["errors"]
+        if job["status"] == "cancelled":
+            st.info("Генерация отменена.")
+        else:
+            if errs:
+                st.toast(errs[0], icon="⚠️")
+            st.error("Ошибка. Проверьте ссылки или макет.")
+            for e in errs:
+                st.write(e)
+
+    if job is not None and job["status"] in ("queued", "running"):
+        show_job_progress(st.session_state.job_id)
+    elif st.session_state.zip_result is None:
         if st.button("Генерация"):
             if not uploaded_pdf:
                 st.toast("Нужен PDF!", icon="⚠️")
@@ -684,38 +718,82 @@ with col_right:
             else:
                 p_n = partner_name.strip()
                 s_n = size_name.strip()
-
-                res, errs = process_files(
-                    uploaded_pdf,
-                    st.session_state.links_final,
+                layouts = {uploaded_pdf.name: uploaded_pdf.getvalue()}
+                for variant in uploaded_variants or []:
+                    layouts.setdefault(variant.name, variant.getvalue())
+                job_id = submit_campaign(
+                    layouts,
+                    list(st.session_state.rows_final),
                     p_n,
                     s_n,
                     pos_mode,
                     x_mm,
                     y_mm,
                     size_mm,
+                    raster_dpi=raster_dpi,
+                    refine_dpi=refine_dpi,
+                    output=output_mode,
+                    qr_vector=qr_vector,
+                    qr_uniform=qr_uniform,
+                    link_policy=link_policy,
+                    render_workers=int(render_workers),
+                    zip_compression=zip_compression,
+                    output_profile=output_profile,
+                    dedupe=dedupe,
+                    page_selection=page_selection,
                 )
-
-                if res:
-                    st.session_state.zip_result = res
-                    st.session_state.zip_name = f"{p_n}_{s_n}.zip"
-                    # Замена experimental_rerun на актуальный вызов
-                    st.rerun()
-                else:
-                    if errs:
-                        st.toast(errs[0], icon="⚠️")
-                    st.error("Ошибка. Проверьте ссылки или макет.")
-                    if errs:
-                        for e in errs:
-                            st.write(e)
+                st.session_state.job_id = job_id
+                st.session_state.job_name = f"{p_n}_{s_n}.{output_mode}"
+                st.query_params["job"] = job_id
+                st.rerun()
     else:
-        st.download_button(
-            "Скачать архив",
-            st.session_state.zip_result,
-            st.session_state.zip_name or "qrs.zip",
-            "application/zip",
-        )
-        st.caption(
-            "После нажатия дождитесь начала загрузки и не нажимайте\n"
-            "кнопку несколько раз подряд."
-        )
+        is_pdf = (st.session_state.zip_name or "").endswith(".pdf")
+        # Задачу и её файл могли убрать по сроку, пока вкладка была открыта.
+        expired = not os.path.exists(st.session_state.zip_result.name)
+        if expired:
+            st.warning(RESULT_EXPIRED)
+        elif results_server() is not None and job is not None:
+            st.link_button(
+                "Скачать PDF" if is_pdf else "Скачать архив",
+                job_result_url(job["id"], st.session_state.zip_name or "qrs.zip"),
+            )
+        else:
+            st.download_button(
+                "Скачать PDF" if is_pdf else "Скачать архив",
+                partial(read_result_bytes, st.session_state.zip_result.name),
+                st.session_state.zip_name or "qrs.zip",
+                "application/pdf" if is_pdf else "application/zip",
+            )
+            st.caption(
+                "После нажатия дождитесь начала загрузки и не нажимайте\n"
+                "кнопку несколько раз подряд."
+            )
+        if job is not None and job["entries"] and not expired:
+            show_ready_file(job, key="ready_file")
+        if st.button(
+            "Собрать заново",
+            help="Поменяйте ссылки или имена и соберите архив ещё раз: "
+            "файлы, у которых не изменились макет, место QR и ссылка, "
+            "возьмутся из этой сборки без рендера.",
+        ):
+            st.session_state.prev_job_id = st.session_state.job_id
+            st.session_state.job_id = None
+            st.session_state.zip_result = None
+            st.session_state.zip_name = None
+            st.query_params.pop("job", None)
+            st.rerun()
+        if st.session_state.detect_timings:
+            st.caption(
+                "Поиск белой области: "
+                + " · ".join(
+                    f"{level} {sec:.2f} с"
+                    for level, sec in st.session_state.detect_timings.items()
+                )
+            )
+        if st.session_state.cache_delta:
+            delta = st.session_state.cache_delta
+            st.caption(
+                f"Кэш QR: попаданий {delta['hits']}, промахов {delta['misses']}"
+            )
+        if st.session_state.report:
+            show_run_report(st.session_state.report)
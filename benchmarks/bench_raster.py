@@ -0,0 +1,161 @@
+# Сравнение прежнего растрового детектора (заливка стеком) с разметкой серий.
+#
+#   python benchmarks/bench_raster.py [--repeat 3]
+#
+# Синтетические страницы: фон с шумом из мелких пятен и несколько белых
+# квадратов. Вариант "light" — светлый макет с тонкой сеткой, где белым
+# оказывается почти вся страница (худший случай для заливки).
+import argparse
+import os
+import random
+import sys
+import time
+
+import fitz
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import _detect_white_rectangles_raster  # noqa: E402
+
+PAGES = {
+    "A4": (595, 842, False),
+    "A4 light": (595, 842, True),
+    "A3": (842, 1191, False),
+    "A3 light": (842, 1191, True),
+    "billboard": (2000, 1000, False),
+}
+
+
+def make_page(width, height, light=False, n_boxes=4, n_specks=400, seed=0):
+    rnd = random.Random(seed)
+    doc = fitz.open()
+    page = doc.new_page(width=width, height=height)
+    if light:
+        for x in range(0, int(width), 40):
+            page.draw_line((x, 0), (x, height), color=(0.3, 0.3, 0.3), width=0.5)
+        for y in range(0, int(height), 40):
+            page.draw_line((0, y), (width, y), color=(0.3, 0.3, 0.3), width=0.5)
+    else:
+        page.draw_rect(page.rect, color=None, fill=(0.85, 0.2, 0.4))
+        for _ in range(n_specks):
+            x, y = rnd.uniform(0, width), rnd.uniform(0, height)
+            s = rnd.uniform(2, 12)
+            page.draw_rect(fitz.Rect(x, y, x + s, y + s), color=None, fill=(1, 1, 1))
+    for _ in range(n_boxes):
+        s = rnd.uniform(0.08, 0.2) * min(width, height)
+        x, y = rnd.uniform(0, width - s), rnd.uniform(0, height - s)
+        page.draw_rect(fitz.Rect(x, y, x + s, y + s), color=None, fill=(1, 1, 1))
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+# Прежняя реализация — эталон для сравнения результатов и времени.
+def legacy_detect_white_rectangles_raster(
+    pdf_bytes: bytes,
+    white_threshold: int = 245,
+    min_area_ratio: float = 0.001,
+    max_area_ratio: float = 0.9,
+):
+    rects_pt = []
+
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page = doc[0]
+        page_w_pt = page.rect.width
+        page_h_pt = page.rect.height
+
+        pix = page.get_pixmap(alpha=False)
+        img_w, img_h = pix.width, pix.height
+        img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(img_h, img_w, 3)
+
+    gray = img.mean(axis=2)
+    mask = gray > white_threshold
+    visited = np.zeros_like(mask, dtype=bool)
+    img_area = img_w * img_h
+
+    def flood_fill(sx, sy):
+        stack = [(sx, sy)]
+        visited[sy, sx] = True
+        min_x = max_x = sx
+        min_y = max_y = sy
+
+        while stack:
+            x, y = stack.pop()
+
+            if x < min_x:
+                min_x = x
+            if x > max_x:
+                max_x = x
+            if y < min_y:
+                min_y = y
+            if y > max_y:
+                max_y = y
+
+            for nx, ny in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                if 0 <= nx < img_w and 0 <= ny < img_h:
+                    if mask[ny, nx] and not visited[ny, nx]:
+                        visited[ny, nx] = True
+                        stack.append((nx, ny))
+
+        return min_x, min_y, max_x, max_y
+
+    for y in range(img_h):
+        for x in range(img_w):
+            if mask[y, x] and not visited[y, x]:
+                x1, y1, x2, y2 = flood_fill(x, y)
+
+                w = x2 - x1 + 1
+                h = y2 - y1 + 1
+                area = w * h
+                area_ratio = area / img_area
+                if area_ratio < min_area_ratio or area_ratio > max_area_ratio:
+                    continue
+
+                aspect = w / h if h != 0 else 0
+                if aspect < 0.5 or aspect > 2.0:
+                    continue
+
+                x_pt = x1 * page_w_pt / img_w
+                y_pt = y1 * page_h_pt / img_h
+                w_pt = w * page_w_pt / img_w
+                h_pt = h * page_h_pt / img_h
+
+                rects_pt.append((x_pt, y_pt, w_pt, h_pt))
+
+    rects_pt.sort(key=lambda r: r[2] * r[3], reverse=True)
+    return rects_pt
+
+
+def best_of(fn, arg, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(arg)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'page':<10} {'legacy, s':>10} {'new, s':>10} {'x':>7}  rects")
+    for name, (w, h, light) in PAGES.items():
+        pdf_bytes = make_page(w, h, light)
+        t_old, old = best_of(legacy_detect_white_rectangles_raster, pdf_bytes, args.repeat)
+        t_new, new = best_of(_detect_white_rectangles_raster, pdf_bytes, args.repeat)
+        same = "ok" if old == new else "MISMATCH"
+        print(
+            f"{name:<10} {t_old:>10.3f} {t_new:>10.3f} {t_old / t_new:>7.1f}  "
+            f"{len(new)} {same}"
+        )
+        if old != new:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
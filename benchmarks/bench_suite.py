@@ -0,0 +1,338 @@
+# Офлайн-бенчмарк всего конвейера: поиск места под QR, получение QR и сборка
+# архива на синтетических макетах и списках ссылок.
+#
+#   python benchmarks/bench_suite.py                      # 10 и 1k ссылок
+#   python benchmarks/bench_suite.py --sizes 10,1000,10000
+#   python benchmarks/bench_suite.py --save-baseline reference
+#   python benchmarks/bench_suite.py --compare reference --tolerance 0.25
+#   python benchmarks/bench_suite.py --only archive --profiles fast,balanced,smallest
+#
+# Макеты: vector — векторный белый квадрат; raster — макет одной картинкой,
+# квадрат находится только растровым поиском; heavy — векторный квадрат и
+# тяжёлые встроенные изображения; multipage — 4 страницы, QR на каждой.
+# Ссылки генерируются детерминированно; для политики auto поднимается
+# локальный HTTP-заглушка: половина ссылок отдаёт PNG, половина — HTML.
+#
+# Каждый замер идёт в отдельном процессе с пустыми кэшами во временной
+# папке, поэтому пиковый RSS (ru_maxrss) относится только к нему. Базовые
+# результаты лежат в benchmarks/baselines/<имя>.json; --compare завершает
+# работу с кодом 1, если какой-то замер медленнее базы больше чем на
+# tolerance. Сборка архива меряется для каждого профиля из --profiles
+# (OUTPUT_PROFILES в core): размер результата против времени.
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fitz
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES_DIR = os.path.join(ROOT, "benchmarks", "baselines")
+LAYOUTS = ("vector", "raster", "heavy", "multipage")
+FETCH_MAX_LINKS = 1000
+
+
+# --- СИНТЕТИЧЕСКИЕ МАКЕТЫ ---
+def _noise_png(width, height, seed):
+    rnd = np.random.default_rng(seed)
+    pix = fitz.Pixmap(fitz.csRGB, width, height, rnd.bytes(width * height * 3), False)
+    return pix.tobytes("png")
+
+
+def make_layout(kind: str) -> bytes:
+    doc = fitz.open()
+    pages = 4 if kind == "multipage" else 1
+    for n in range(pages):
+        page = doc.new_page(width=595, height=842)
+        box = fitz.Rect(360, 600, 360 + 170, 600 + 170)
+        if kind == "raster":
+            img = np.full((842, 595, 3), (40, 70, 160), dtype=np.uint8)
+            img[600:770, 360:530] = 255
+            pix = fitz.Pixmap(fitz.csRGB, 595, 842, img.tobytes(), False)
+            page.insert_image(page.rect, pixmap=pix)
+            continue
+        page.draw_rect(page.rect, color=None, fill=(0.15, 0.3, 0.6))
+        for i in range(40):
+            y = 20 + i * 14
+            bar = fitz.Rect(30, y, 330, y + 8)
+            page.draw_rect(bar, color=None, fill=(0.9, 0.8, 0.2))
+        if kind == "heavy":
+            for i in range(4):
+                x = 30 + (i % 2) * 160
+                y = 600 + (i // 2) * 110
+                rect = fitz.Rect(x, y, x + 150, y + 100)
+                page.insert_image(rect, stream=_noise_png(320, 240, seed=i))
+        page.draw_rect(box, color=None, fill=(1, 1, 1))
+        page.insert_text((40, 40 + n * 10), f"Страница {n + 1}", color=(1, 1, 1))
+    data = doc.tobytes(deflate=True)
+    doc.close()
+    return data
+
+
+# --- ССЫЛКИ И HTTP-ЗАГЛУШКА ---
+def make_links(count: int, base: str = "https://example.com") -> list:
+    return [
+        f"{base}/p/{i:06d}?utm_source=bench&n={i * 7919 % 100000}" for i in range(count)
+    ]
+
+
+def make_fetch_links(count: int, base: str) -> list:
+    return [
+        f"{base}/img/{i}.png" if i % 2 == 0 else f"{base}/page/{i}" for i in range(count)
+    ]
+
+
+def _stub_png():
+    img = np.zeros((200, 200), dtype=np.uint8)
+    img[::10] = 255
+    pix = fitz.Pixmap(fitz.csGRAY, 200, 200, img.tobytes(), False)
+    return pix.tobytes("png")
+
+
+def start_http_stub():
+    png = _stub_png()
+    html = b"<html><body>landing</body></html>"
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            is_img = self.path.startswith("/img/")
+            body = png if is_img else html
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png" if is_img else "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# --- ЗАМЕРЫ (в дочернем процессе) ---
+def _rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(case: dict) -> dict:
+    cache_root = tempfile.mkdtemp(prefix="kyuarych-bench-")
+    for var, sub in (
+        ("QR_CACHE_DIR", "qr"),
+        ("LAYOUT_CACHE_DIR", "layouts"),
+        ("RESULTS_DIR", "results"),
+    ):
+        os.environ[var] = os.path.join(cache_root, sub)
+    sys.path.insert(0, ROOT)
+    import core
+
+    stage = case["stage"]
+    result = dict(case)
+    layout = make_layout(case.get("layout", "vector"))
+    rss_before = _rss_mb()
+
+    if stage == "detect":
+        repeat = case["repeat"]
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            placements, _ = core.resolve_qr_rects(
+                layout, "все", "white_rect", 0, 0, 0, layout_cache=False
+            )
+        elapsed = time.perf_counter() - t0
+        result.update(items=repeat, found=len(placements))
+
+    elif stage == "qr":
+        server = None
+        if case["policy"] == "generate":
+            links = make_links(case["links"])
+        else:
+            server, base = start_http_stub()
+            links = make_fetch_links(case["links"], base)
+        t0 = time.perf_counter()
+        payloads = list(
+            core.iter_qr_payloads(
+                links, vector=True, policy=case["policy"], cache=False
+            )
+        )
+        elapsed = time.perf_counter() - t0
+        if server is not None:
+            server.shutdown()
+        result.update(items=len(links), failed=sum(p is None for p in payloads))
+
+    else:
+        links = make_links(case["links"])
+        t0 = time.perf_counter()
+        with tempfile.TemporaryFile() as out:
+            _, errors = core.process_files(
+                layout,
+                links,
+                "Bench",
+                "0x0",
+                "white_rect",
+                0,
+                0,
+                0,
+                link_policy="generate",
+                qr_cache=False,
+                layout_cache=False,
+                incremental=False,
+                page_selection="все",
+                result_file=out,
+                zip_compression=case.get("compression", 0),
+                output_profile=case.get("profile", "fast"),
+            )
+            out.seek(0, os.SEEK_END)
+            size = out.tell()
+        elapsed = time.perf_counter() - t0
+        result.update(items=len(links), errors=len(errors), output_bytes=size)
+
+    result.update(
+        elapsed_s=round(elapsed, 4),
+        per_s=round(result["items"] / elapsed, 2) if elapsed else None,
+        peak_rss_mb=round(_rss_mb(), 1),
+        rss_growth_mb=round(_rss_mb() - rss_before, 1),
+    )
+    return result
+
+
+# --- ЗАПУСК И СРАВНЕНИЕ ---
+def case_name(case: dict) -> str:
+    parts = [case["stage"]]
+    if case["stage"] != "qr":
+        parts.append(case["layout"])
+    if "links" in case:
+        parts.append(str(case["links"]))
+    if case.get("policy", "generate") != "generate":
+        parts.append(case["policy"])
+    if "profile" in case:
+        parts.append(case["profile"])
+    return "/".join(parts)
+
+
+def build_cases(sizes, detect_repeat: int, profiles=("fast",)) -> list:
+    cases = [{"stage": "detect", "layout": k, "repeat": detect_repeat} for k in LAYOUTS]
+    for n in sizes:
+        cases.append({"stage": "qr", "links": n, "policy": "generate"})
+        if n <= FETCH_MAX_LINKS:
+            cases.append({"stage": "qr", "links": n, "policy": "auto"})
+    for n in sizes:
+        for kind in LAYOUTS:
+            for profile in profiles:
+                cases.append(
+                    {"stage": "archive", "layout": kind, "links": n, "profile": profile}
+                )
+    return cases
+
+
+def run_in_child(case: dict) -> dict:
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--case", json.dumps(case)],
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        return dict(case, error=proc.stderr.strip().splitlines()[-1:])
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def environment() -> dict:
+    from importlib.metadata import version
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "pymupdf": fitz.VersionBind,
+        "qrcode": version("qrcode"),
+        "numpy": np.__version__,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> int:
+    base = {case_name(r): r for r in baseline["results"]}
+    slower = 0
+    print(f"\n{'case':<36} {'base/s':>10} {'now/s':>10} {'delta':>8}")
+    for r in results:
+        b = base.get(case_name(r))
+        if not b or not b.get("per_s") or not r.get("per_s"):
+            continue
+        delta = r["per_s"] / b["per_s"] - 1
+        mark = ""
+        if delta < -tolerance:
+            mark = "  SLOWER"
+            slower += 1
+        print(f"{case_name(r):<36} {b['per_s']:>10.1f} {r['per_s']:>10.1f} {delta:>+8.0%}{mark}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,1000", help="Размеры списков ссылок")
+    parser.add_argument("--detect-repeat", type=int, default=20)
+    parser.add_argument(
+        "--profiles", default="fast", help="Профили сохранения PDF для сборки"
+    )
+    parser.add_argument("--only", help="Только замеры, чьё имя начинается так")
+    parser.add_argument("--out", help="Записать результаты в JSON")
+    parser.add_argument("--save-baseline", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    profiles = [p for p in args.profiles.split(",") if p]
+    cases = build_cases(sizes, args.detect_repeat, profiles)
+    if args.only:
+        cases = [c for c in cases if case_name(c).startswith(args.only)]
+
+    print(f"{'case':<36} {'items/s':>10} {'time, s':>9} {'RSS, MB':>8} {'out, MB':>8}")
+    results = []
+    for case in cases:
+        r = run_in_child(case)
+        results.append(r)
+        if "error" in r:
+            print(f"{case_name(case):<36} ERROR {r['error']}")
+            continue
+        out_mb = r.get("output_bytes", 0) / 1024 / 1024
+        print(
+            f"{case_name(case):<36} {r['per_s']:>10.1f} {r['elapsed_s']:>9.2f} "
+            f"{r['peak_rss_mb']:>8.1f} {out_mb:>8.2f}"
+        )
+
+    report = {"environment": environment(), "results": results}
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+    if args.save_baseline:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        path = os.path.join(BASELINES_DIR, args.save_baseline + ".json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        print(f"\nБаза сохранена: {path}")
+    if args.compare:
+        with open(os.path.join(BASELINES_DIR, args.compare + ".json"), encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# Проверка быстрого кодировщика QR (make_qr_encoder / encode_qr) против
+# эталонного qrcode: матрицы должны совпадать бит в бит.
+#
+#   python benchmarks/check_qr_encoder.py [--seed 0] [--random 200]
+#
+# Набор ссылок покрывает цифровой, буквенно-цифровой и байтовый режимы
+# (и их смесь в одной ссылке), все уровни коррекции и версии от 1 до 40:
+# каждая ссылка кодируется в своей минимальной версии и в версии побольше,
+# где данные добиваются заполнением, ссылки из FIXED_LINKS — ещё и в 40-й.
+# При расхождении — MISMATCH и код 1.
+import argparse
+import os
+import random
+import string
+import sys
+
+import numpy as np
+import qrcode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import (  # noqa: E402
+    QR_OPTIMIZE_CHUNKS,
+    _qr_data_chunks,
+    _qr_min_version,
+    encode_qr,
+    make_qr_encoder,
+)
+
+ECC_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H,
+}
+
+FIXED_LINKS = [
+    # цифровой режим
+    "0",
+    "12345678",
+    "4607001234567" * 3,
+    "9" * 300,
+    # буквенно-цифровой
+    "HTTPS://EXAMPLE.COM",
+    "HTTPS://QR.EXAMPLE.RU/ABC-123/$%*+./:",
+    "HTTP://A.RU/" + "X" * 400,
+    # байтовый
+    "https://example.com/promo?utm_source=qr&utm_medium=print",
+    "https://пример.рф/акция?город=москва",
+    "www.example.com/" + "a" * 200,
+    # смесь режимов в одной ссылке
+    "https://a.ru/p/0000000000000000000000/ABCDEFGHIJKLMNOPQRSTUV/x",
+    "HTTPS://SHOP.RU/ITEM/1234567890123456789?ref=qr",
+    "tel:+79001234567",
+    # длинные, до старших версий
+    "https://example.com/?" + "k=v&" * 250,
+    "1" * 2000,
+]
+
+
+def random_links(count: int, seed: int):
+    rnd = random.Random(seed)
+    alphabets = [
+        string.digits,
+        string.digits + string.ascii_uppercase + " $%*+-./:",
+        string.ascii_letters + string.digits + "-._~/?=&",
+    ]
+    for _ in range(count):
+        length = rnd.choice([5, 20, 60, 150, 400])
+        yield "https://a.ru/" + "".join(
+            rnd.choice(rnd.choice(alphabets)) for _ in range(length)
+        )
+
+
+def reference_matrix(link: str, version: int, ecc):
+    qr = qrcode.QRCode(version=version, error_correction=ecc, border=0)
+    qr.add_data(link, optimize=QR_OPTIMIZE_CHUNKS)
+    qr.make(fit=False)
+    return np.array(qr.get_matrix(), dtype=bool)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--random", type=int, default=200)
+    args = parser.parse_args()
+
+    links = FIXED_LINKS + list(random_links(args.random, args.seed))
+    encoders = {}
+    checked = 0
+    versions = set()
+    print(f"{'ecc':<4} {'links':>6} {'checked':>8}  versions")
+    for name, ecc in ECC_LEVELS.items():
+        fitted = 0
+        level_checked = 0
+        level_versions = set()
+        for link in links:
+            try:
+                version = _qr_min_version(_qr_data_chunks(link), ecc)
+            except qrcode.exceptions.DataOverflowError:
+                continue
+            fitted += 1
+            targets = {version, min(40, version + 3)}
+            if link in FIXED_LINKS:
+                targets.add(40)
+            for v in sorted(targets):
+                if (v, ecc) not in encoders:
+                    encoders[(v, ecc)] = make_qr_encoder(v, ecc)
+                got = encode_qr(encoders[(v, ecc)], link)
+                want = reference_matrix(link, v, ecc)
+                level_checked += 1
+                level_versions.add(v)
+                if got is None or not np.array_equal(got, want):
+                    print(f"MISMATCH ecc {name} version {v}: {link[:80]!r}")
+                    sys.exit(1)
+        checked += level_checked
+        versions |= level_versions
+        print(
+            f"{name:<4} {fitted:>6} {level_checked:>8}  "
+            f"{min(level_versions)}–{max(level_versions)}"
+        )
+    print(f"ok: {checked} матриц, версий {len(versions)}")
+
+
+if __name__ == "__main__":
+    main()
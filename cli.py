@@ -0,0 +1,208 @@
+# Кюарыч без браузера: пакетная генерация из командной строки (cron, CI).
+#
+#   python cli.py layout.pdf links.xlsx -o out.zip --partner Partner --size 0x0
+#   python cli.py layout.pdf links.csv.gz --format pdf --pages все --jsonl
+#   python cli.py a4.pdf campaign.xlsx --layout a5.pdf --layout banner.pdf
+#
+# Колонки «qr_layout», «qr_x_mm», «qr_y_mm», «qr_size_mm», «qr_pages» в
+# файле ссылок задают для строки свой вариант макета (имя файла из --layout)
+# и место QR.
+#
+# С --jsonl в stdout построчно идут JSON-события: "start", "progress" (не
+# чаще раза на процент), "done" с итогом и ошибками. Код выхода 0 — есть
+# хотя бы один QR, 1 — ничего не получилось.
+import argparse
+import json
+import os
+import sys
+import time
+
+from core import (
+    FETCH_DEADLINE_S,
+    FETCH_PER_HOST,
+    FETCH_WORKERS,
+    LINK_POLICIES,
+    OUTPUT_PROFILES,
+    TEXT_LINK_TYPES,
+    extract_link_rows_from_excel,
+    extract_link_rows_from_text_file,
+    new_run_stats,
+    process_campaign,
+    run_stats_report,
+)
+
+
+def read_link_rows(path: str) -> list:
+    with open(path, "rb") as f:
+        if path.lower().endswith(".xlsx"):
+            return extract_link_rows_from_excel(f)
+        return extract_link_rows_from_text_file(f, os.path.basename(path))
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        prog="cli.py", description="Вставка QR-кодов в PDF-макет по списку ссылок."
+    )
+    p.add_argument("pdf", help="PDF-макет (основной вариант)")
+    p.add_argument(
+        "links",
+        help="Файл со ссылками: .xlsx или " + ", ".join(TEXT_LINK_TYPES),
+    )
+    p.add_argument(
+        "--layout",
+        action="append",
+        default=[],
+        help="Другой вариант макета; строки выбирают его по имени файла",
+    )
+    p.add_argument("-o", "--output", help="Куда записать результат")
+    p.add_argument("--partner", default="Partner", help="Имя партнера")
+    p.add_argument("--size", default="0x0", help="Размер файла")
+    p.add_argument("--format", choices=("zip", "pdf"), default="zip")
+    p.add_argument(
+        "--mode",
+        choices=("auto", "manual"),
+        default="auto",
+        help="auto — белый квадрат на макете, manual — координаты",
+    )
+    p.add_argument("--x-mm", type=float, default=20.0)
+    p.add_argument("--y-mm", type=float, default=20.0)
+    p.add_argument("--size-mm", type=float, default=20.0)
+    p.add_argument("--pages", default="1", help="Страницы для QR: «1,3-5», «все»")
+    p.add_argument("--raster-dpi", type=int, default=72)
+    p.add_argument("--refine-dpi", type=int, default=None)
+    p.add_argument("--png", action="store_true", help="QR картинкой, а не вектором")
+    p.add_argument("--policy", choices=LINK_POLICIES, default="auto")
+    p.add_argument("--fetch-workers", type=int, default=FETCH_WORKERS)
+    p.add_argument("--fetch-per-host", type=int, default=FETCH_PER_HOST)
+    p.add_argument("--fetch-deadline", type=float, default=FETCH_DEADLINE_S)
+    p.add_argument("--workers", type=int, default=1, help="Процессов для сборки PDF")
+    p.add_argument("--compression", type=int, default=0, choices=range(10))
+    p.add_argument(
+        "--profile",
+        choices=tuple(OUTPUT_PROFILES),
+        default="fast",
+        help="Оптимизация PDF: fast — как есть, smallest — минимальный размер",
+    )
+    p.add_argument("--no-cache", action="store_true", help="Не использовать кэши")
+    p.add_argument("--no-dedupe", action="store_true")
+    p.add_argument("--no-uniform", action="store_true")
+    p.add_argument(
+        "--no-incremental",
+        action="store_true",
+        help="Собрать архив целиком, не беря файлы из прошлой сборки",
+    )
+    p.add_argument("--jsonl", action="store_true", help="Прогресс JSON-строками")
+    p.add_argument("--report", help="Куда записать отчёт о скорости (JSON)")
+    return p.parse_args(argv)
+
+
+def _emit(event: str, **fields):
+    fields["event"] = event
+    sys.stdout.write(json.dumps(fields, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+# Прогресс в stdout (JSON) или stderr (текст), не чаще раза на процент.
+def make_progress(jsonl: bool):
+    last = [-1]
+
+    def progress(done, total, text):
+        step = done * 100 // max(total, 1)
+        if step == last[0] and 0 < done < total:
+            return
+        last[0] = step
+        if jsonl:
+            _emit("progress", done=done, total=total, text=text)
+        else:
+            sys.stderr.write(f"\r{text}")
+            if done == total:
+                sys.stderr.write("\n")
+            sys.stderr.flush()
+
+    return progress
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    started = time.perf_counter()
+    output = args.output or f"{args.partner}_{args.size}.{args.format}"
+
+    rows = read_link_rows(args.links)
+    layouts = {}
+    for path in [args.pdf, *args.layout]:
+        with open(path, "rb") as f:
+            layouts[os.path.basename(path)] = f.read()
+    if args.jsonl:
+        _emit("start", links=len(rows), output=output)
+
+    # Пишем во временный файл рядом: прошлый архив по тому же пути ещё нужен
+    # для инкрементальной сборки и не должен обрезаться до её конца.
+    partial_path = output + ".part"
+    detect_timings = {}
+    stats = new_run_stats()
+    with open(partial_path, "wb") as out:
+        res, errors = process_campaign(
+            layouts,
+            rows,
+            args.partner,
+            args.size,
+            "white_rect" if args.mode == "auto" else "manual",
+            args.x_mm,
+            args.y_mm,
+            args.size_mm,
+            raster_dpi=args.raster_dpi,
+            refine_dpi=args.refine_dpi,
+            detect_timings=detect_timings,
+            output=args.format,
+            qr_vector=not args.png,
+            fetch_workers=args.fetch_workers,
+            fetch_per_host=args.fetch_per_host,
+            fetch_deadline_s=args.fetch_deadline,
+            link_policy=args.policy,
+            qr_cache=not args.no_cache,
+            render_workers=args.workers,
+            zip_compression=args.compression,
+            dedupe=not args.no_dedupe,
+            page_selection=args.pages,
+            layout_cache=not args.no_cache,
+            qr_uniform=not args.no_uniform,
+            progress=make_progress(args.jsonl),
+            result_file=out,
+            incremental=not args.no_incremental,
+            archive_path=os.path.abspath(output),
+            stats=stats,
+            output_profile=args.profile,
+        )
+    if res is None:
+        os.remove(partial_path)
+    else:
+        os.replace(partial_path, output)
+
+    elapsed = time.perf_counter() - started
+    report = run_stats_report(stats)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+    if args.jsonl:
+        _emit(
+            "done",
+            ok=res is not None,
+            output=output if res is not None else None,
+            links=len(rows),
+            errors=errors,
+            detect_timings=detect_timings,
+            stages=report["stages"],
+            elapsed_s=round(elapsed, 3),
+        )
+    else:
+        for err in errors:
+            sys.stderr.write(err + "\n")
+        if res is not None:
+            print(f"{output}: {len(rows)} ссылок, ошибок {len(errors)}, {elapsed:.1f} с")
+        else:
+            print("Не удалось создать ни одного QR.", file=sys.stderr)
+    return 0 if res is not None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
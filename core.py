@@ -0,0 +1,2967 @@
+# Ядро Кюарыча: поиск места под QR, получение/генерация QR и сборка PDF.
+# Модуль не зависит от Streamlit — его импортирует app.py и рабочие процессы.
+import fitz  # PyMuPDF
+import io
+import csv
+import gzip
+import codecs
+import zipfile
+import requests
+import qrcode
+from PIL import Image
+from openpyxl import load_workbook
+from openpyxl.utils import range_boundaries
+import numpy as np
+import re
+import os
+import posixpath
+import xml.etree.ElementTree as ET
+import json
+import hashlib
+import tempfile
+import time
+import threading
+import struct
+import zlib
+from bisect import bisect_left
+from collections import Counter, deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from urllib.parse import parse_qs, quote, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+
+# --- КОНСТАНТЫ ---
+MM_TO_POINT = 72 / 25.4
+HEADERS = {"User-Agent": "Mozilla/5.0"}
+FETCH_TIMEOUT_S = 3
+FETCH_WORKERS = 16
+FETCH_PER_HOST = 4
+FETCH_DEADLINE_S = 60
+FETCH_MAX_BYTES = 10 * 1024 * 1024
+FETCH_SNIFF_BYTES = 4096
+
+# Что делать со ссылкой: auto — скачать, если по ссылке картинка, иначе
+# сгенерировать QR; generate — только генерация; fetch — только скачивание.
+LINK_POLICIES = ("auto", "generate", "fetch")
+QR_CACHE_DIR = os.environ.get(
+    "QR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "kyuarych-qr-cache")
+)
+QR_CACHE_MAX_BYTES = 256 * 1024 * 1024
+QR_CACHE_TTL_S = 24 * 3600
+QR_CACHE_VERSION = 1
+LAYOUT_CACHE_DIR = os.environ.get(
+    "LAYOUT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "kyuarych-layouts")
+)
+LAYOUT_CACHE_MAX_FILES = 2000
+LAYOUT_CACHE_MEMORY_ENTRIES = 128
+LAYOUT_CACHE_VERSION = 2
+RESULTS_DIR = os.environ.get(
+    "RESULTS_DIR", os.path.join(tempfile.gettempdir(), "kyuarych-results")
+)
+RESULTS_TTL_S = 6 * 3600
+RESULTS_SWEEP_EVERY_S = 10 * 60
+BUILDS_DIR = os.path.join(RESULTS_DIR, "builds")
+# Раздача результатов по HTTP (см. start_results_server): 0 — выключена.
+# RESULTS_HTTP_URL — адрес, по которому сервер видит браузер (прокси и т.п.).
+RESULTS_HTTP_PORT = int(os.environ.get("RESULTS_HTTP_PORT", 0))
+RESULTS_HTTP_HOST = os.environ.get("RESULTS_HTTP_HOST", "127.0.0.1")
+RESULTS_HTTP_URL = os.environ.get(
+    "RESULTS_HTTP_URL", f"http://localhost:{RESULTS_HTTP_PORT}"
+).rstrip("/")
+RESULTS_HTTP_CHUNK = 1024 * 1024
+
+# Как сохранять готовые PDF (параметры fitz Document.tobytes): fast — как
+# есть, balanced — сжатие потоков, чистка содержимого страниц и потоки
+# объектов (в 2–4 раза меньше почти без потерь времени), smallest — вдобавок
+# дедупликация одинаковых объектов и потоков, пережатие картинок и шрифтов.
+# Уже сжатые фотографии в макете ни один профиль не уменьшит. По умолчанию —
+# fast: balanced и smallest переписывают потоки содержимого макета, поэтому
+# включаются только явно.
+OUTPUT_PROFILES = {
+    "fast": {},
+    "balanced": {"garbage": 1, "deflate": True, "clean": True, "use_objstms": 1},
+    "smallest": {
+        "garbage": 4,
+        "deflate": True,
+        "deflate_images": True,
+        "deflate_fonts": True,
+        "clean": True,
+        "use_objstms": 1,
+        "compression_effort": 100,
+    },
+}
+IMAGE_MAGIC = (
+    b"\x89PNG\r\n\x1a\n",
+    b"\xff\xd8\xff",
+    b"GIF87a",
+    b"GIF89a",
+    b"BM",
+    b"II*\x00",
+    b"MM\x00*",
+)
+
+
+def mm_to_pt(mm_val: float) -> float:
+    return mm_val * MM_TO_POINT
+
+
+# --- ЗАМЕРЫ ---
+# Отчёт о прогоне: время и байты по этапам (stages) и запись на каждую
+# обработанную ссылку (links: источник QR, исход сети, время загрузки,
+# кодирования и рендера). Везде stats=None означает «не мерить». Этапы
+# пишутся и из потоков загрузки, поэтому под замком.
+def new_run_stats() -> dict:
+    return {
+        "started": time.time(),
+        "stages": {},
+        "links": [],
+        "counters": {},
+        "lock": threading.Lock(),
+    }
+
+
+def add_stage(stats, stage: str, seconds: float, nbytes: int = 0):
+    if stats is None:
+        return
+    with stats["lock"]:
+        s = stats["stages"].setdefault(
+            stage, {"count": 0, "total_s": 0.0, "max_s": 0.0, "bytes": 0}
+        )
+        s["count"] += 1
+        s["total_s"] += seconds
+        s["max_s"] = max(s["max_s"], seconds)
+        s["bytes"] += nbytes
+
+
+def add_counter(stats, name: str, value: int = 1):
+    if stats is None:
+        return
+    with stats["lock"]:
+        stats["counters"][name] = stats["counters"].get(name, 0) + value
+
+
+# Снимок для интерфейса и выгрузки в JSON.
+def run_stats_report(stats) -> dict:
+    with stats["lock"]:
+        stages = {
+            name: {
+                "count": s["count"],
+                "total_s": round(s["total_s"], 4),
+                "max_s": round(s["max_s"], 4),
+                "bytes": s["bytes"],
+            }
+            for name, s in stats["stages"].items()
+        }
+        links = [dict(t) for t in stats["links"]]
+        counters = dict(stats["counters"])
+    return {
+        "version": 1,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(stats["started"])),
+        "wall_s": round(time.time() - stats["started"], 3),
+        "stages": stages,
+        "counters": counters,
+        "output_profile": stats.get("output_profile"),
+        "sources": dict(Counter(t.get("source") or "none" for t in links)),
+        "network": dict(Counter(t["network"] for t in links if t.get("network"))),
+        "detect": {k: round(v, 4) for k, v in stats.get("detect", {}).items()},
+        "links": links,
+    }
+
+
+# --- QR-ИЗОБРАЖЕНИЕ ---
+def _clean_link(link):
+    if not link or str(link).lower() == "nan":
+        return None
+    link = str(link).strip()
+    return link or None
+
+
+def _download_url(link: str) -> str:
+    if not link.startswith("http"):
+        return "https://" + link
+    return link
+
+
+def _link_host(link: str):
+    try:
+        return urlsplit(_download_url(link)).hostname
+    except ValueError:
+        return None
+
+
+def _looks_like_image(head: bytes) -> bool:
+    if head.startswith(IMAGE_MAGIC):
+        return True
+    return head[:4] == b"RIFF" and head[8:12] == b"WEBP"
+
+
+# Ссылка может вести прямо на картинку (готовый QR) — тогда берём её.
+# stop_at — момент (time.monotonic), после которого в сеть уже не ходим;
+# host_slots — семафоры {хост: BoundedSemaphore}, ограничивающие число
+# одновременных запросов к одному хосту.
+# sniff — ответ читается потоком: если Content-Type или первые байты не
+# похожи на картинку, соединение закрывается, не дочитав страницу.
+# Тело больше FETCH_MAX_BYTES не скачивается в любом режиме. PNG и JPEG
+# PyMuPDF вставляет как есть — их байты отдаются без перекодирования, Pillow
+# только читает заголовок; остальные форматы переводятся в PNG.
+# Возвращает (image_bytes | None, статус): "image", "not_image" — сервер
+# ответил, но это не картинка; "error" — сбой сети/декодирования;
+# "skipped" — срок партии истёк, запрос не делался.
+def _fetch_remote_image(
+    link: str, session=None, stop_at=None, host_slots=None, sniff=True
+):
+    download_url = _download_url(link)
+    slot = host_slots.get(_link_host(link)) if host_slots else None
+    if slot is not None:
+        wait = None if stop_at is None else max(0.0, stop_at - time.monotonic())
+        if not slot.acquire(timeout=wait):
+            return None, "skipped"
+
+    try:
+        timeout = FETCH_TIMEOUT_S
+        if stop_at is not None:
+            timeout = min(timeout, stop_at - time.monotonic())
+            if timeout <= 0:
+                return None, "skipped"
+
+        with (session or requests).get(
+            download_url, headers=HEADERS, timeout=timeout, stream=True
+        ) as resp:
+            if resp.status_code != 200:
+                return None, "error"
+
+            ctype = resp.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            if sniff and ctype and not (
+                ctype.startswith("image/") or ctype.endswith("octet-stream")
+            ):
+                return None, "not_image"
+
+            length = resp.headers.get("Content-Length", "")
+            if length.isdigit() and int(length) > FETCH_MAX_BYTES:
+                return None, "not_image"
+
+            chunks = resp.iter_content(FETCH_SNIFF_BYTES)
+            head = next(chunks, b"")
+            if sniff and not _looks_like_image(head):
+                return None, "not_image"
+
+            body = bytearray(head)
+            for chunk in chunks:
+                body += chunk
+                if len(body) > FETCH_MAX_BYTES:
+                    return None, "not_image"
+
+        with Image.open(io.BytesIO(body)) as pil_img:
+            if pil_img.format in ("PNG", "JPEG"):
+                return bytes(body), "image"
+            img_byte_arr = io.BytesIO()
+            pil_img.save(img_byte_arr, format="PNG")
+        return img_byte_arr.getvalue(), "image"
+    except Exception:
+        return None, "error"
+    finally:
+        if slot is not None:
+            slot.release()
+
+
+# Матрица модулей QR без рамки: список строк из True/False.
+def get_qr_matrix(link: str):
+    try:
+        qr = qrcode.QRCode(border=0)
+        qr.add_data(link)
+        qr.make(fit=True)
+        return qr.get_matrix()
+    except Exception:
+        return None
+
+
+# --- ПАКЕТНОЕ КОДИРОВАНИЕ QR ---
+# Версия символа (размер в модулях) и уровень коррекции выбираются один раз
+# на партию: наименьшая версия, в которую при уровне M влезает самая длинная
+# ссылка, и самый сильный уровень коррекции, который влезает в ту же версию.
+# Все QR партии получаются одного размера, и модуль на печати одинаковый.
+QR_ECC_PREFERENCE = (
+    qrcode.constants.ERROR_CORRECT_H,
+    qrcode.constants.ERROR_CORRECT_Q,
+    qrcode.constants.ERROR_CORRECT_M,
+)
+QR_OPTIMIZE_CHUNKS = 20  # как в QRCode.add_data
+
+# Шаблоны 1:1:3:1:1 со светлой полосой из 4 модулей (штраф N3) как числа.
+_QR_FINDER_LIKE = (0b10111010000, 0b00001011101)
+
+
+def _qr_data_chunks(link: str):
+    return list(qrcode.util.optimal_data_chunks(link, minimum=QR_OPTIMIZE_CHUNKS))
+
+
+# Битовый поток данных (режим, длина, содержимое каждого куска) как одно
+# целое число: заметно быстрее побитового qrcode.util.BitBuffer.
+def _qr_bit_stream(chunks, version: int):
+    mode_sizes = qrcode.util.mode_sizes_for_version(version)
+    value = 0
+    nbits = 0
+    for data in chunks:
+        value = (value << 4) | data.mode
+        value = (value << mode_sizes[data.mode]) | len(data)
+        nbits += 4 + mode_sizes[data.mode]
+        raw = data.data
+        if data.mode == qrcode.util.MODE_NUMBER:
+            for i in range(0, len(raw), 3):
+                part = raw[i : i + 3]
+                size = qrcode.util.NUMBER_LENGTH[len(part)]
+                value = (value << size) | int(part)
+                nbits += size
+        elif data.mode == qrcode.util.MODE_ALPHA_NUM:
+            alpha = qrcode.util.ALPHA_NUM
+            for i in range(0, len(raw), 2):
+                part = raw[i : i + 2]
+                if len(part) > 1:
+                    value = (value << 11) | (
+                        alpha.find(part[:1]) * 45 + alpha.find(part[1:])
+                    )
+                    nbits += 11
+                else:
+                    value = (value << 6) | alpha.find(part)
+                    nbits += 6
+        else:
+            value = (value << 8 * len(raw)) | int.from_bytes(raw, "big")
+            nbits += 8 * len(raw)
+    return value, nbits
+
+
+def _qr_needed_bits(chunks, version: int) -> int:
+    return _qr_bit_stream(chunks, version)[1]
+
+
+# То же, что QRCode.best_fit, но без объекта QRCode на каждую ссылку.
+def _qr_min_version(chunks, ecc) -> int:
+    version = 1
+    while True:
+        bits = _qr_needed_bits(chunks, version)
+        found = bisect_left(qrcode.util.BIT_LIMIT_TABLE[ecc], bits, version)
+        if found > 40:
+            raise qrcode.exceptions.DataOverflowError()
+        if qrcode.util.mode_sizes_for_version(
+            found
+        ) is qrcode.util.mode_sizes_for_version(version):
+            return found
+        version = found
+
+
+# (версия, уровень коррекции) для всей партии или None, если кодировать нечего.
+def plan_qr_batch(links):
+    ecc_m = qrcode.constants.ERROR_CORRECT_M
+    fitting = []
+    version = 0
+    for url in links:
+        link = _clean_link(url)
+        if not link:
+            continue
+        chunks = _qr_data_chunks(link)
+        try:
+            version = max(version, _qr_min_version(chunks, ecc_m))
+        except qrcode.exceptions.DataOverflowError:
+            continue
+        fitting.append(chunks)
+    if not version:
+        return None
+
+    need = max(_qr_needed_bits(chunks, version) for chunks in fitting)
+    for ecc in QR_ECC_PREFERENCE:
+        if need <= qrcode.util.BIT_LIMIT_TABLE[ecc][version]:
+            return version, ecc
+    return version, ecc_m
+
+
+# Порождающий многочлен Рида — Соломона: логарифмы коэффициентов без
+# старшей единицы, как в qrcode.util.create_bytes.
+def _rs_generator_logs(ec_count: int):
+    exp = qrcode.base.EXP_TABLE
+    log = qrcode.base.LOG_TABLE
+    poly = [1]
+    for i in range(ec_count):
+        nxt = poly + [0]
+        for j in range(1, len(nxt)):
+            if poly[j - 1]:
+                nxt[j] ^= exp[(log[poly[j - 1]] + i) % 255]
+        poly = nxt
+    return [log[g] for g in poly[1:]]
+
+
+def _rs_remainder(data, gen_logs):
+    exp = qrcode.base.EXP_TABLE
+    log = qrcode.base.LOG_TABLE
+    rem = [0] * len(gen_logs)
+    for byte in data:
+        factor = byte ^ rem[0]
+        rem = rem[1:] + [0]
+        if factor:
+            lf = log[factor]
+            for k, gl in enumerate(gen_logs):
+                rem[k] ^= exp[(gl + lf) % 255]
+    return rem
+
+
+# Кодовые слова символа: данные с терминатором и заполнителями, коррекция
+# по блокам и чередование блоков — байт в байт как qrcode.util.create_data.
+def _qr_codewords(encoder: dict, chunks):
+    value, nbits = _qr_bit_stream(chunks, encoder["version"])
+    limit = encoder["data_bits"]
+    if nbits > limit:
+        return None
+    pad = min(limit - nbits, 4)
+    pad += (8 - (nbits + pad) % 8) % 8
+    value <<= pad
+    nbits += pad
+    data = list(value.to_bytes(nbits // 8, "big"))
+    data += [
+        qrcode.util.PAD0 if i % 2 == 0 else qrcode.util.PAD1
+        for i in range((limit - nbits) // 8)
+    ]
+
+    dc_blocks = []
+    ec_blocks = []
+    offset = 0
+    for dc, ec in encoder["blocks"]:
+        block = data[offset : offset + dc]
+        offset += dc
+        dc_blocks.append(block)
+        ec_blocks.append(_rs_remainder(block, encoder["generators"][ec]))
+
+    out = []
+    for blocks in (dc_blocks, ec_blocks):
+        for i in range(max(len(b) for b in blocks)):
+            out.extend(b[i] for b in blocks if i < len(b))
+    return out
+
+
+def _qr_mask_planes(n: int):
+    i, j = np.indices((n, n))
+    return np.array(
+        [
+            (i + j) % 2 == 0,
+            i % 2 == 0,
+            j % 3 == 0,
+            (i + j) % 3 == 0,
+            (i // 2 + j // 3) % 2 == 0,
+            (i * j) % 2 + (i * j) % 3 == 0,
+            ((i * j) % 2 + (i * j) % 3) % 2 == 0,
+            ((i * j) % 3 + (i + j) % 2) % 2 == 0,
+        ]
+    )
+
+
+# Всё, что не зависит от ссылки, считается один раз: служебные узоры с
+# форматной информацией под каждую из 8 масок, маски в области данных и
+# порядок обхода модулей данных (как в QRCode.map_data).
+def make_qr_encoder(version: int, ecc) -> dict:
+    qr = qrcode.QRCode(version=version, error_correction=ecc, border=0)
+    n = version * 4 + 17
+    qr.modules_count = n
+    qr.modules = [[None] * n for _ in range(n)]
+    qr.setup_position_probe_pattern(0, 0)
+    qr.setup_position_probe_pattern(n - 7, 0)
+    qr.setup_position_probe_pattern(0, n - 7)
+    qr.setup_position_adjust_pattern()
+    qr.setup_timing_pattern()
+    qr.setup_type_info(True, 0)
+    if version >= 7:
+        qr.setup_type_number(True)
+
+    data_region = np.array([[v is None for v in row] for row in qr.modules])
+    base_test = np.array([[bool(v) for v in row] for row in qr.modules])
+
+    order = []
+    row, inc = n - 1, -1
+    for col in range(n - 1, 0, -2):
+        if col <= 6:
+            col -= 1
+        while True:
+            for c in (col, col - 1):
+                if data_region[row, c]:
+                    order.append((row, c))
+            row += inc
+            if row < 0 or row >= n:
+                row -= inc
+                inc = -inc
+                break
+
+    base = np.empty((8, n, n), dtype=bool)
+    for mask in range(8):
+        qr.setup_type_info(False, mask)
+        if version >= 7:
+            qr.setup_type_number(False)
+        base[mask] = [[bool(v) for v in row] for row in qr.modules]
+
+    blocks = [
+        (b.data_count, b.total_count - b.data_count)
+        for b in qrcode.base.rs_blocks(version, ecc)
+    ]
+    generators = {ec: _rs_generator_logs(ec) for _, ec in blocks}
+
+    return {
+        "version": version,
+        "ecc": ecc,
+        "size": n,
+        "blocks": blocks,
+        "generators": generators,
+        "data_bits": sum(dc for dc, _ in blocks) * 8,
+        "order": tuple(np.array(order).T),
+        "masks": _qr_mask_planes(n) & data_region,
+        "base_test": base_test,
+        "base": base,
+        "local": threading.local(),
+    }
+
+
+# Штрафы N1–N4 для стопки кандидатов (k, n, n) разом; совпадают с
+# qrcode.util.lost_point, поэтому выбор маски тот же, что у библиотеки.
+def _qr_penalties(stack):
+    k, n, _ = stack.shape
+    lines = np.concatenate([stack, stack.transpose(0, 2, 1)], axis=1)
+
+    flat = lines.reshape(-1, n)
+    starts = np.ones(flat.shape, dtype=bool)
+    starts[:, 1:] = flat[:, 1:] != flat[:, :-1]
+    starts = starts.ravel()
+    lengths = np.bincount(np.cumsum(starts) - 1)
+    owner = np.flatnonzero(starts) // (2 * n * n)
+    n1 = np.bincount(owner, weights=np.where(lengths >= 5, lengths - 2, 0), minlength=k)
+
+    a = stack[:, :-1, :-1]
+    n2 = (
+        (a == stack[:, 1:, :-1]) & (a == stack[:, :-1, 1:]) & (a == stack[:, 1:, 1:])
+    ).sum(axis=(1, 2)) * 3
+
+    codes = np.zeros((k, 2 * n, n - 10), dtype=np.int16)
+    for t in range(11):
+        codes <<= 1
+        codes |= lines[:, :, t : t + n - 10]
+    n3 = ((codes == _QR_FINDER_LIKE[0]) | (codes == _QR_FINDER_LIKE[1])).sum(
+        axis=(1, 2)
+    ) * 40
+
+    n4 = [
+        int(abs(float(dark) / (n * n) * 100 - 50) / 5) * 10
+        for dark in stack.sum(axis=(1, 2)).tolist()
+    ]
+    return n1 + n2 + n3 + np.array(n4)
+
+
+# Матрица модулей без рамки (numpy, True — тёмный) или None. Буферы под
+# данные и 8 кандидатов выделяются один раз на поток и переиспользуются.
+def encode_qr(encoder: dict, link: str):
+    try:
+        codewords = _qr_codewords(encoder, _qr_data_chunks(link))
+    except Exception:
+        return None
+    if codewords is None:
+        return None
+
+    local = encoder["local"]
+    if getattr(local, "data", None) is None:
+        n = encoder["size"]
+        local.data = np.zeros((n, n), dtype=bool)
+        local.bits = np.zeros(len(encoder["order"][0]), dtype=bool)
+        local.stack = np.empty((8, n, n), dtype=bool)
+
+    bits = np.unpackbits(np.array(codewords, dtype=np.uint8)).astype(bool)
+    local.bits[:] = False
+    local.bits[: len(bits)] = bits
+    local.data[encoder["order"]] = local.bits
+
+    np.bitwise_xor(local.data, encoder["masks"], out=local.stack)
+    np.bitwise_or(local.stack, encoder["base_test"], out=local.stack)
+    mask = int(np.argmin(_qr_penalties(local.stack)))
+
+    return encoder["base"][mask] | (local.data ^ encoder["masks"][mask])
+
+
+# Вся партия одним вызовом: план, кодировщик, затем матрицы по порядку.
+def encode_qr_batch(links, plan=None):
+    plan = plan or plan_qr_batch(links)
+    encoder = make_qr_encoder(*plan) if plan else None
+    for url in links:
+        link = _clean_link(url)
+        yield encode_qr(encoder, link) if encoder and link else None
+
+
+# Растровый QR — модули матрицы оттенками серого (0 — чёрный, 255 — белый),
+# uint8 n×n. В PDF он попадает через fitz.Pixmap, без PNG и Pillow.
+def _qr_pixels(matrix) -> np.ndarray:
+    return np.where(np.asarray(matrix, dtype=bool), 0, 255).astype(np.uint8)
+
+
+def _is_qr_pixels(qr) -> bool:
+    return isinstance(qr, np.ndarray) and qr.dtype == np.uint8
+
+
+# Каждый модуль растягивается в квадрат box_size×box_size записью прямо в
+# буфер будущего Pixmap через представление numpy, без промежуточных
+# массивов; MuPDF копирует буфер к себе и сам пишет в PDF 1-битную картинку.
+def _qr_pixmap(pixels: np.ndarray, box_size: int = 10):
+    h, w = pixels.shape
+    buf = bytearray(h * box_size * w * box_size)
+    view = np.frombuffer(buf, dtype=np.uint8).reshape(h, box_size, w, box_size)
+    view[...] = pixels[:, None, :, None]
+    return fitz.Pixmap(fitz.csGRAY, w * box_size, h * box_size, buf, False)
+
+
+# --- КЭШ QR НА ДИСКЕ ---
+# Файл на запись: ключ — SHA-256 от ссылки и параметров отрисовки/политики.
+# Первая строка — JSON с типом данных и сроком годности, дальше тело
+# (картинка или матрица строками из 0/1; у растрового QR 1 — чёрный
+# модуль). Время доступа хранится в mtime файла: при переполнении
+# QR_CACHE_MAX_BYTES удаляются самые давно использованные.
+QR_CACHE_STATS = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+_qr_cache_lock = threading.Lock()
+_qr_cache_size = None
+
+
+def _qr_cache_key(link: str, vector: bool, policy: str, plan=None) -> str:
+    params = {
+        "v": QR_CACHE_VERSION,
+        "link": link,
+        "vector": vector,
+        "box_size": 10,
+        "border": 0,
+        "policy": policy,
+    }
+    if plan:
+        params["qr"] = [plan[0], plan[1]]
+    raw = json.dumps(params, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _qr_cache_path(key: str) -> str:
+    return os.path.join(QR_CACHE_DIR, key[:2], key)
+
+
+def _qr_cache_count(name: str):
+    with _qr_cache_lock:
+        QR_CACHE_STATS[name] += 1
+
+
+def qr_cache_stats() -> dict:
+    with _qr_cache_lock:
+        return dict(QR_CACHE_STATS)
+
+
+# Учёт общего размера кэша: delta — на сколько байт он изменился.
+def _qr_cache_resize(delta: int):
+    global _qr_cache_size
+
+    with _qr_cache_lock:
+        if _qr_cache_size is None:
+            _qr_cache_size = _qr_cache_scan()[1]
+        else:
+            _qr_cache_size += delta
+        if _qr_cache_size > QR_CACHE_MAX_BYTES:
+            _qr_cache_evict()
+
+
+def qr_cache_get(key: str):
+    path = _qr_cache_path(key)
+    try:
+        with open(path, "rb") as f:
+            meta = json.loads(f.readline())
+            body = f.read()
+            size = f.tell()
+    except (OSError, ValueError):
+        _qr_cache_count("misses")
+        return None
+
+    expires = meta.get("expires")
+    if expires is not None and expires < time.time():
+        _qr_cache_count("expired")
+        _qr_cache_count("misses")
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        else:
+            _qr_cache_resize(-size)
+        return None
+
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    _qr_cache_count("hits")
+
+    if meta.get("kind") in ("matrix", "pixels"):
+        matrix = [[c == 49 for c in row] for row in body.split(b"\n")]
+        return _qr_pixels(matrix) if meta["kind"] == "pixels" else matrix
+    return body
+
+
+def qr_cache_put(key: str, payload, ttl_s=None):
+    if isinstance(payload, bytes):
+        kind, body = "png", payload
+    else:
+        kind = "matrix"
+        if _is_qr_pixels(payload):
+            kind, payload = "pixels", payload == 0
+        body = b"\n".join(bytes(49 if v else 48 for v in row) for row in payload)
+    meta = {"kind": kind, "expires": time.time() + ttl_s if ttl_s else None}
+    data = json.dumps(meta).encode("utf-8") + b"\n" + body
+
+    # Запись может заменить старый файл (истёкший или обновлённый), тогда к
+    # размеру кэша прибавляется только разница.
+    path = _qr_cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.replace(tmp, path)
+    except OSError:
+        return
+
+    _qr_cache_resize(len(data) - replaced)
+
+
+def _qr_cache_scan():
+    entries = []
+    total = 0
+    for root, _, files in os.walk(QR_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+            total += info.st_size
+    return entries, total
+
+
+# Вызывается под _qr_cache_lock: чистим до 90% лимита, старые — первыми.
+def _qr_cache_evict():
+    global _qr_cache_size
+
+    entries, total = _qr_cache_scan()
+    entries.sort()
+    target = QR_CACHE_MAX_BYTES * 0.9
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        QR_CACHE_STATS["evicted"] += 1
+    _qr_cache_size = total
+
+
+# Результат для вставки: байты картинки по ссылке, пиксели растрового QR
+# (см. _qr_pixels) либо матрица модулей для векторной отрисовки.
+# policy — см. LINK_POLICIES.
+# С encoder QR строится пакетным кодировщиком в общей для партии версии.
+# Кэшируются только результаты, которые не зависят от случайного сбоя сети;
+# всё, что получено с участием сети, живёт не дольше QR_CACHE_TTL_S.
+def get_or_generate_qr(
+    link: str,
+    vector: bool = True,
+    session=None,
+    stop_at=None,
+    host_slots=None,
+    policy: str = "auto",
+    cache: bool = True,
+    encoder: dict = None,
+    stats: dict = None,
+    trace: dict = None,
+):
+    if trace is None:
+        trace = {}
+    link = _clean_link(link)
+    if not link:
+        return None
+
+    plan = (encoder["version"], encoder["ecc"]) if encoder else None
+    key = _qr_cache_key(link, vector, policy, plan) if cache else None
+    if key:
+        t0 = time.perf_counter()
+        cached = qr_cache_get(key)
+        add_stage(stats, "cache_lookup", time.perf_counter() - t0)
+        if cached is not None:
+            trace["source"] = "cache"
+            return cached
+
+    status = "skipped"
+    if policy != "generate":
+        t0 = time.perf_counter()
+        remote, status = _fetch_remote_image(
+            link, session, stop_at, host_slots, sniff=policy == "auto"
+        )
+        trace["fetch_s"] = round(time.perf_counter() - t0, 4)
+        trace["network"] = status
+        add_stage(stats, "fetch", trace["fetch_s"], len(remote or b""))
+        if remote:
+            trace["source"] = "fetch"
+            trace["bytes"] = len(remote)
+            if key:
+                qr_cache_put(key, remote, ttl_s=QR_CACHE_TTL_S)
+            return remote
+        if policy == "fetch":
+            return None
+
+    t0 = time.perf_counter()
+    if encoder is not None:
+        payload = encode_qr(encoder, link)
+    else:
+        payload = get_qr_matrix(link)
+    if payload is not None and not vector:
+        payload = _qr_pixels(payload)
+    trace["encode_s"] = round(time.perf_counter() - t0, 4)
+    nbytes = len(payload) if isinstance(payload, bytes) else 0
+    add_stage(stats, "qr_encode", trace["encode_s"], nbytes)
+    if payload is not None:
+        trace["source"] = "generate"
+        if nbytes:
+            trace["bytes"] = nbytes
+    if key and payload is not None:
+        if policy == "generate":
+            qr_cache_put(key, payload)
+        elif status == "not_image":
+            qr_cache_put(key, payload, ttl_s=QR_CACHE_TTL_S)
+    return payload
+
+
+def get_or_generate_qr_image(
+    link: str,
+    session=None,
+    stop_at=None,
+    host_slots=None,
+    policy: str = "auto",
+    stats: dict = None,
+    trace: dict = None,
+):
+    return get_or_generate_qr(
+        link, False, session, stop_at, host_slots, policy, stats=stats, trace=trace
+    )
+
+
+# --- ПАРАЛЛЕЛЬНОЕ ПОЛУЧЕНИЕ QR ---
+# Общая сессия с пулом соединений (keep-alive) на все потоки.
+def make_http_session(per_host: int = FETCH_PER_HOST):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=per_host)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Ссылки обрабатываются пулом потоков, результаты отдаются строго в порядке
+# входного списка по мере готовности. В работе держится не больше
+# 2 * workers ссылок: следующая отправляется в пул, когда отдана одна из
+# готовых, поэтому картинки не копятся в памяти. После deadline_s секунд от
+# старта сеть больше не опрашивается — оставшиеся QR только генерируются.
+# С uniform все генерируемые QR партии кодируются в одной версии (см.
+# plan_qr_batch); plan можно передать готовым, если ссылки — часть большей
+# партии, а stop_at (time.monotonic) — общим сроком на всю партию вместо
+# deadline_s. В traces (список) дописываются записи о ссылках в порядке
+# links — те же, что попадают в stats["links"].
+def iter_qr_payloads(
+    links,
+    vector: bool = True,
+    workers: int = FETCH_WORKERS,
+    per_host: int = FETCH_PER_HOST,
+    deadline_s: float = FETCH_DEADLINE_S,
+    policy: str = "auto",
+    cache: bool = True,
+    uniform: bool = True,
+    plan=None,
+    stats: dict = None,
+    stop_at=None,
+    traces: list = None,
+):
+    if stop_at is None and deadline_s:
+        stop_at = time.monotonic() + deadline_s
+    if plan is None and uniform and policy != "fetch":
+        plan = plan_qr_batch(links)
+    encoder = make_qr_encoder(*plan) if plan else None
+    link_traces = [{"link": str(url)} for url in links]
+    if traces is not None:
+        traces.extend(link_traces)
+    if stats is not None:
+        with stats["lock"]:
+            stats["links"].extend(link_traces)
+    host_slots = {}
+    for url in links:
+        link = _clean_link(url)
+        if link and policy != "generate":
+            host = _link_host(link)
+            if host not in host_slots:
+                host_slots[host] = threading.BoundedSemaphore(max(1, per_host))
+
+    workers = max(1, workers)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    window = deque()
+
+    def _result(fut):
+        try:
+            return fut.result()
+        except Exception:
+            return None
+
+    try:
+        with make_http_session(per_host) as session:
+            for url, trace in zip(links, link_traces):
+                window.append(
+                    pool.submit(
+                        get_or_generate_qr,
+                        url,
+                        vector,
+                        session,
+                        stop_at,
+                        host_slots,
+                        policy,
+                        cache,
+                        encoder,
+                        stats,
+                        trace,
+                    )
+                )
+                if len(window) >= 2 * workers:
+                    yield _result(window.popleft())
+            while window:
+                yield _result(window.popleft())
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+# Склейка модулей: горизонтальные серии в строке, одинаковые серии соседних
+# строк объединяются в один прямоугольник (x0, y0, x1, y1) в модулях.
+def _qr_module_rects(matrix):
+    rects = []
+    open_runs = {}
+
+    rows = matrix.tolist() if isinstance(matrix, np.ndarray) else list(matrix)
+    for y, row in enumerate(rows + [[]]):
+        runs = []
+        x = 0
+        n = len(row)
+        while x < n:
+            if row[x]:
+                x0 = x
+                while x < n and row[x]:
+                    x += 1
+                runs.append((x0, x))
+            else:
+                x += 1
+
+        for run in list(open_runs):
+            if run not in runs:
+                rects.append((run[0], open_runs.pop(run), run[1], y))
+        for run in runs:
+            open_runs.setdefault(run, y)
+
+    return rects
+
+
+def draw_qr_vector(page, rect, matrix):
+    n = len(matrix)
+    module = rect.width / n
+    shape = page.new_shape()
+    shape.draw_rect(rect)
+    shape.finish(color=None, fill=(1, 1, 1))
+    for x0, y0, x1, y1 in _qr_module_rects(matrix):
+        shape.draw_rect(
+            fitz.Rect(
+                rect.x0 + x0 * module,
+                rect.y0 + y0 * module,
+                rect.x0 + x1 * module,
+                rect.y0 + y1 * module,
+            )
+        )
+    shape.finish(color=None, fill=(0, 0, 0))
+    shape.commit()
+
+
+def insert_qr(page, rect, qr):
+    if isinstance(qr, bytes):
+        page.insert_image(rect, stream=qr)
+    elif _is_qr_pixels(qr):
+        page.insert_image(rect, pixmap=_qr_pixmap(qr))
+    else:
+        draw_qr_vector(page, rect, qr)
+
+
+# --- РАСТРОВЫЙ ДЕТЕКТОР БЕЛЫХ ОБЛАСТЕЙ ---
+# Связные области (4-соседство) маски: серии пикселей по строкам + union-find.
+# Возвращает рамки (N, 4) x1, y1, x2, y2 включительно в порядке первого пикселя
+# области при построчном обходе — тот же порядок, что у прежней заливки.
+def _label_white_components(mask: np.ndarray) -> np.ndarray:
+    img_h, img_w = mask.shape
+    if img_h == 0 or img_w == 0:
+        return np.empty((0, 4), dtype=np.int64)
+
+    # Серии белых пикселей в каждой строке: [start, end)
+    padded = np.zeros((img_h, img_w + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    run_rows, run_starts = np.nonzero(edges == 1)
+    _, run_ends = np.nonzero(edges == -1)
+    n_runs = run_rows.size
+    if n_runs == 0:
+        return np.empty((0, 4), dtype=np.int64)
+
+    # Серии соседних строк касаются, если их отрезки пересекаются.
+    # Ключи row * stride + col упорядочены глобально, поэтому для каждой серии
+    # перекрывающиеся серии строки выше образуют непрерывный диапазон [lo, hi).
+    stride = img_w + 1
+    start_keys = run_rows * stride + run_starts
+    end_keys = run_rows * stride + run_ends
+    above = (run_rows - 1) * stride
+    lo = np.searchsorted(end_keys, above + run_starts, side="right")
+    hi = np.searchsorted(start_keys, above + run_ends, side="left")
+    counts = np.clip(hi - lo, 0, None)
+    counts[run_rows == 0] = 0
+
+    lower = np.repeat(np.arange(n_runs), counts)
+    offsets = np.arange(lower.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    upper = np.repeat(lo, counts) + offsets
+
+    parent = list(range(n_runs))
+    for a, b in zip(upper.tolist(), lower.tolist()):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        while parent[b] != b:
+            parent[b] = parent[parent[b]]
+            b = parent[b]
+        if a < b:
+            parent[b] = a
+        elif b < a:
+            parent[a] = b
+
+    parent = np.array(parent)
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            break
+        parent = grand
+
+    # Корень — минимальный индекс серии, т.е. первая серия области в обходе.
+    _, labels = np.unique(parent, return_inverse=True)
+    n_labels = labels.max() + 1
+
+    boxes = np.empty((n_labels, 4), dtype=np.int64)
+    boxes[:, 0] = img_w
+    boxes[:, 1] = img_h
+    boxes[:, 2] = -1
+    boxes[:, 3] = -1
+    np.minimum.at(boxes[:, 0], labels, run_starts)
+    np.minimum.at(boxes[:, 1], labels, run_rows)
+    np.maximum.at(boxes[:, 2], labels, run_ends - 1)
+    np.maximum.at(boxes[:, 3], labels, run_rows)
+    return boxes
+
+
+def _render_white_mask(page, dpi: int, white_threshold: int, clip=None):
+    pix = page.get_pixmap(dpi=dpi, clip=clip, alpha=False)
+    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(
+        pix.height, pix.width, pix.n
+    )
+    return img.mean(axis=2) > white_threshold, pix
+
+
+# Фильтр рамок по доле площади и пропорциям. slack — допуск в пикселях на
+# сторону: на грубом растре края области размыты, окончательно рамку
+# проверяют после уточнения.
+def _keep_raster_boxes(w, h, img_area, min_area_ratio, max_area_ratio, slack=0):
+    w_lo, w_hi = np.maximum(w - slack, 1), w + slack
+    h_lo, h_hi = np.maximum(h - slack, 1), h + slack
+    return (
+        (w_hi * h_hi / img_area >= min_area_ratio)
+        & (w_lo * h_lo / img_area <= max_area_ratio)
+        & (w_hi / h_lo >= 0.5)
+        & (w_lo / h_hi <= 2.0)
+    )
+
+
+# Уточнение кандидатов: рендерим только окрестность каждой области в высоком
+# разрешении и берём самую крупную белую область внутри.
+def _refine_white_rectangles(
+    page,
+    candidates,
+    dpi: int,
+    coarse_dpi: int,
+    white_threshold: int,
+    min_area_ratio: float,
+    max_area_ratio: float,
+):
+    page_rect = page.rect
+    page_area = page_rect.width * page_rect.height
+    zoom = dpi / 72
+    pad = 2 * 72 / coarse_dpi
+    refined = []
+
+    for x, y, w, h in candidates:
+        clip = fitz.Rect(x - pad, y - pad, x + w + pad, y + h + pad) & page_rect
+        mask, pix = _render_white_mask(page, dpi, white_threshold, clip=clip)
+        boxes = _label_white_components(mask)
+        if not len(boxes):
+            continue
+
+        bw = boxes[:, 2] - boxes[:, 0] + 1
+        bh = boxes[:, 3] - boxes[:, 1] + 1
+        i = int(np.argmax(bw * bh))
+        w_pt = int(bw[i]) / zoom
+        h_pt = int(bh[i]) / zoom
+
+        area_ratio = w_pt * h_pt / page_area
+        if area_ratio < min_area_ratio or area_ratio > max_area_ratio:
+            continue
+        aspect = w_pt / h_pt
+        if aspect < 0.5 or aspect > 2.0:
+            continue
+
+        rect = (
+            (pix.x + int(boxes[i, 0])) / zoom,
+            (pix.y + int(boxes[i, 1])) / zoom,
+            w_pt,
+            h_pt,
+        )
+        if rect not in refined:
+            refined.append(rect)
+
+    return refined
+
+
+# dpi — разрешение сплошного растра. Если задан refine_dpi выше dpi, включается
+# пирамида: кандидаты ищутся на грубом растре, края уточняются по вырезкам.
+# В timings (если передан) записывается время каждого уровня.
+def _detect_white_rectangles_raster(
+    pdf_bytes: bytes,
+    white_threshold: int = 245,
+    min_area_ratio: float = 0.001,
+    max_area_ratio: float = 0.9,
+    dpi: int = 72,
+    refine_dpi: int = None,
+    timings: dict = None,
+    page_no: int = 0,
+):
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return _raster_rects_on_page(
+            doc[page_no],
+            white_threshold,
+            min_area_ratio,
+            max_area_ratio,
+            dpi,
+            refine_dpi,
+            timings,
+        )
+
+
+def _raster_rects_on_page(
+    page,
+    white_threshold: int = 245,
+    min_area_ratio: float = 0.001,
+    max_area_ratio: float = 0.9,
+    dpi: int = 72,
+    refine_dpi: int = None,
+    timings: dict = None,
+):
+    pyramid = refine_dpi is not None and refine_dpi > dpi
+    t0 = time.perf_counter()
+
+    page_w_pt = page.rect.width
+    page_h_pt = page.rect.height
+
+    mask, pix = _render_white_mask(page, dpi, white_threshold)
+    img_w, img_h = pix.width, pix.height
+    boxes = _label_white_components(mask)
+
+    w = boxes[:, 2] - boxes[:, 0] + 1
+    h = boxes[:, 3] - boxes[:, 1] + 1
+    keep = _keep_raster_boxes(
+        w,
+        h,
+        img_w * img_h,
+        min_area_ratio,
+        max_area_ratio,
+        slack=2 if pyramid else 0,
+    )
+
+    rects_pt = [
+        (
+            x1 * page_w_pt / img_w,
+            y1 * page_h_pt / img_h,
+            bw * page_w_pt / img_w,
+            bh * page_h_pt / img_h,
+        )
+        for (x1, y1, _, _), bw, bh in zip(
+            boxes[keep].tolist(), w[keep].tolist(), h[keep].tolist()
+        )
+    ]
+    if timings is not None:
+        timings[f"raster {dpi} dpi"] = time.perf_counter() - t0
+
+    if pyramid:
+        t1 = time.perf_counter()
+        rects_pt = _refine_white_rectangles(
+            page,
+            rects_pt,
+            refine_dpi,
+            dpi,
+            white_threshold,
+            min_area_ratio,
+            max_area_ratio,
+        )
+        if timings is not None:
+            timings[f"raster {refine_dpi} dpi"] = time.perf_counter() - t1
+
+    rects_pt.sort(key=lambda r: r[2] * r[3], reverse=True)
+    return rects_pt
+
+
+# --- ДЕТЕКТОР БЕЛЫХ КВАДРАТОВ В PDF ---
+# get_cdrawings отдаёт сырые кортежи без Rect/Point и без пересчёта каждой
+# фигуры в объекты Python: на макетах с десятками тысяч путей это заметно
+# быстрее get_drawings. Фильтр по цвету и площади идёт по числам, объекты
+# не создаются вовсе.
+def _vector_rects_on_page(page):
+    rects_pt = []
+    page_rect = page.rect
+    page_w_pt = page_rect.width
+    page_h_pt = page_rect.height
+    min_area = 0.001 * page_w_pt * page_h_pt
+    max_area = 0.6 * page_w_pt * page_h_pt
+
+    for d in page.get_cdrawings():
+        fill = d.get("fill") or d.get("color")
+        if fill is None:
+            continue
+
+        fr, fg, fb = fill
+        if fr < 0.95 or fg < 0.95 or fb < 0.95:
+            continue
+
+        x0, y0, x1, y1 = d["rect"]
+        w_pt = x1 - x0
+        h_pt = y1 - y0
+        if w_pt <= 0 or h_pt <= 0:
+            continue
+
+        area = w_pt * h_pt
+        if area < min_area or area > max_area:
+            continue
+
+        if w_pt < 0.5 * h_pt or w_pt > 2.0 * h_pt:
+            continue
+
+        rects_pt.append((x0, y0, w_pt, h_pt))
+
+    rects_pt.sort(key=lambda r: r[2] * r[3], reverse=True)
+    return _drop_nested_rects(rects_pt, page_w_pt, page_h_pt)
+
+
+# Белые фигуры часто дублируются (заливка и обводка отдельными путями) или
+# вложены друг в друга (подложка и карточка на ней). Оставляем только
+# внешние: прямоугольник отбрасывается, если он больше чем наполовину лежит
+# в уже принятом. Принятые раскладываются по сетке, поэтому каждый кандидат
+# сравнивается только с соседями по ячейкам, а не со всеми.
+def _drop_nested_rects(rects_pt, page_w_pt, page_h_pt, cells: int = 16):
+    cell_w = max(page_w_pt, 1.0) / cells
+    cell_h = max(page_h_pt, 1.0) / cells
+    grid = {}
+    kept = []
+
+    for rect in rects_pt:
+        x0, y0, w, h = rect
+        x1, y1 = x0 + w, y0 + h
+        cols = range(int(x0 // cell_w), int(x1 // cell_w) + 1)
+        rows = range(int(y0 // cell_h), int(y1 // cell_h) + 1)
+
+        nested = False
+        seen = set()
+        for cx in cols:
+            for cy in rows:
+                for i in grid.get((cx, cy), ()):
+                    if i in seen:
+                        continue
+                    seen.add(i)
+                    kx0, ky0, kw, kh = kept[i]
+                    ix = min(x1, kx0 + kw) - max(x0, kx0)
+                    iy = min(y1, ky0 + kh) - max(y0, ky0)
+                    if ix > 0 and iy > 0 and ix * iy > 0.5 * w * h:
+                        nested = True
+                        break
+                if nested:
+                    break
+            if nested:
+                break
+        if nested:
+            continue
+
+        for cx in cols:
+            for cy in rows:
+                grid.setdefault((cx, cy), []).append(len(kept))
+        kept.append(rect)
+
+    return kept
+
+
+def detect_white_rectangles_on_page(
+    page,
+    raster_dpi: int = 72,
+    refine_dpi: int = None,
+    timings: dict = None,
+):
+    t0 = time.perf_counter()
+    rects_pt = _vector_rects_on_page(page)
+    if timings is not None:
+        timings["vector"] = time.perf_counter() - t0
+
+    if rects_pt:
+        return rects_pt
+
+    return _raster_rects_on_page(
+        page, dpi=raster_dpi, refine_dpi=refine_dpi, timings=timings
+    )
+
+
+def detect_white_rectangles_in_pdf(
+    pdf_bytes: bytes,
+    raster_dpi: int = 72,
+    refine_dpi: int = None,
+    timings: dict = None,
+    page_no: int = 0,
+):
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return detect_white_rectangles_on_page(
+            doc[page_no], raster_dpi, refine_dpi, timings
+        )
+
+
+# --- КЭШ РАЗМЕТКИ МАКЕТА ---
+# Найденные белые области и размер страницы по ключу SHA-256 от PDF, номера
+# страницы и параметров поиска. Горячие записи держатся в памяти процесса
+# (переживают перезапуски скрипта Streamlit), все — в маленьких JSON-файлах
+# на диске (переживают сессии и перезапуск сервера). На диске не больше
+# LAYOUT_CACHE_MAX_FILES файлов, лишние удаляются по давности использования.
+LAYOUT_CACHE_STATS = {"hits": 0, "misses": 0}
+_layout_memory = {}
+_layout_lock = threading.Lock()
+
+
+def pdf_digest(pdf_bytes: bytes) -> str:
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def _layout_cache_key(digest: str, page_no: int, raster_dpi, refine_dpi) -> str:
+    params = {
+        "v": LAYOUT_CACHE_VERSION,
+        "pdf": digest,
+        "page": page_no,
+        "raster_dpi": raster_dpi,
+        "refine_dpi": refine_dpi,
+    }
+    raw = json.dumps(params, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _layout_cache_path(key: str) -> str:
+    return os.path.join(LAYOUT_CACHE_DIR, key + ".json")
+
+
+def _layout_remember(key: str, entry: dict):
+    with _layout_lock:
+        _layout_memory.pop(key, None)
+        _layout_memory[key] = entry
+        while len(_layout_memory) > LAYOUT_CACHE_MEMORY_ENTRIES:
+            _layout_memory.pop(next(iter(_layout_memory)))
+
+
+def layout_cache_get(key: str):
+    with _layout_lock:
+        entry = _layout_memory.get(key)
+    if entry is None:
+        path = _layout_cache_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with _layout_lock:
+                LAYOUT_CACHE_STATS["misses"] += 1
+            return None
+        entry["rects"] = [tuple(r) for r in entry["rects"]]
+    _layout_remember(key, entry)
+    with _layout_lock:
+        LAYOUT_CACHE_STATS["hits"] += 1
+    return entry
+
+
+def layout_cache_put(key: str, page_size, rects):
+    entry = {"page": list(page_size), "rects": [tuple(r) for r in rects]}
+    _layout_remember(key, entry)
+    try:
+        os.makedirs(LAYOUT_CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=LAYOUT_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp, _layout_cache_path(key))
+        _layout_cache_evict()
+    except OSError:
+        pass
+
+
+def layout_cache_stats() -> dict:
+    with _layout_lock:
+        return dict(LAYOUT_CACHE_STATS)
+
+
+def _layout_cache_evict():
+    names = [n for n in os.listdir(LAYOUT_CACHE_DIR) if n.endswith(".json")]
+    if len(names) <= LAYOUT_CACHE_MAX_FILES:
+        return
+    entries = []
+    for name in names:
+        path = os.path.join(LAYOUT_CACHE_DIR, name)
+        try:
+            entries.append((os.stat(path).st_mtime, path))
+        except OSError:
+            continue
+    entries.sort()
+    for _, path in entries[: len(entries) - int(LAYOUT_CACHE_MAX_FILES * 0.9)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# --- ПОДГОТОВКА ШАБЛОНА ---
+# Выбор страниц: "" — первая, "все"/"all"/"*" — все, иначе номера и
+# диапазоны с единицы: "3", "1,3-5". Возвращает индексы с нуля.
+def parse_page_selection(selection, page_count: int) -> list:
+    text = str(selection or "").strip().lower()
+    if not text:
+        return [0]
+    if text in ("все", "all", "*"):
+        return list(range(page_count))
+
+    pages = []
+    for part in re.split(r"[,;\s]+", text):
+        if not part:
+            continue
+        bounds = part.split("-", 1)
+        try:
+            first = int(bounds[0])
+            last = int(bounds[1]) if len(bounds) == 2 else first
+        except ValueError:
+            raise ValueError(f"Не понял номер страницы: «{part}»")
+        if first < 1 or last < first or last > page_count:
+            raise ValueError(
+                f"Страницы «{part}» нет в макете (всего страниц: {page_count})"
+            )
+        for n in range(first - 1, last):
+            if n not in pages:
+                pages.append(n)
+    return pages or [0]
+
+
+# QR в найденном белом квадрате: самый большой не меньше 25 мм, отступ 2 мм.
+def _qr_rect_in_white_area(white_rects_raw):
+    min_size_mm = 25.0
+    white_rects = [
+        r for r in white_rects_raw if min(r[2], r[3]) / MM_TO_POINT >= min_size_mm
+    ]
+    if not white_rects:
+        return None, "Белый квадрат не найден или его сторона меньше 25 мм."
+
+    rx, ry, rw, rh = white_rects[0]
+    margin_pt = mm_to_pt(2.0)
+    inner_w = rw - 2 * margin_pt
+    inner_h = rh - 2 * margin_pt
+    qr_size_pt = min(inner_w, inner_h)
+
+    if qr_size_pt <= 0:
+        return None, "Подходящий квадрат найден, но внутренняя область слишком маленькая."
+
+    x_pt = rx + margin_pt + (inner_w - qr_size_pt) / 2
+    y_pt = ry + margin_pt + (inner_h - qr_size_pt) / 2
+    return fitz.Rect(x_pt, y_pt, x_pt + qr_size_pt, y_pt + qr_size_pt), None
+
+
+# Место QR на выбранных страницах: детектор запускается лениво и только
+# на запрошенных страницах, а результат каждой страницы берётся из кэша
+# разметки, если этот PDF с теми же параметрами уже разбирали.
+# Возвращает ({страница: rect}, ошибки). Страницы без места пропускаются
+# с ошибкой в списке; если места нет нигде — словарь пустой.
+def resolve_qr_rects(
+    pdf_bytes,
+    page_selection,
+    mode,
+    x_mm,
+    y_mm,
+    size_mm,
+    raster_dpi=72,
+    refine_dpi=None,
+    detect_timings=None,
+    layout_cache=True,
+):
+    placements = {}
+    errors = []
+    digest = pdf_digest(pdf_bytes) if mode == "white_rect" and layout_cache else None
+
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        try:
+            pages = parse_page_selection(page_selection, doc.page_count)
+        except ValueError as e:
+            return {}, [str(e)]
+        multi = len(pages) > 1
+
+        for page_no in pages:
+            prefix = f"Стр. {page_no + 1}: " if multi else ""
+
+            if mode != "white_rect":
+                x_pt = mm_to_pt(x_mm)
+                y_pt = mm_to_pt(y_mm)
+                qr_size_pt = mm_to_pt(size_mm)
+                placements[page_no] = fitz.Rect(
+                    x_pt, y_pt, x_pt + qr_size_pt, y_pt + qr_size_pt
+                )
+                continue
+
+            t0 = time.perf_counter()
+            key = None
+            entry = None
+            if digest:
+                key = _layout_cache_key(digest, page_no, raster_dpi, refine_dpi)
+                entry = layout_cache_get(key)
+
+            if entry is not None:
+                rects = entry["rects"]
+                if detect_timings is not None:
+                    detect_timings[f"{prefix}кэш"] = time.perf_counter() - t0
+            else:
+                page = doc[page_no]
+                page_timings = {}
+                try:
+                    rects = detect_white_rectangles_on_page(
+                        page, raster_dpi, refine_dpi, page_timings
+                    )
+                except Exception as e:
+                    errors.append(f"{prefix}Автообнаружение: ошибка {e}")
+                    continue
+                if key:
+                    layout_cache_put(key, (page.rect.width, page.rect.height), rects)
+                if detect_timings is not None:
+                    for level, sec in page_timings.items():
+                        detect_timings[f"{prefix}{level}"] = sec
+
+            rect, err = _qr_rect_in_white_area(rects)
+            if err:
+                errors.append(f"{prefix}{err}")
+            else:
+                placements[page_no] = rect
+
+    return placements, errors
+
+
+# Копия уже разобранного макета + QR на каждой странице из placements.
+# Шаблон открывается один раз на партию, insert_pdf переносит объекты без
+# повторного разбора исходного файла. save_options — профиль из
+# OUTPUT_PROFILES.
+def render_page_with_qr(
+    template_doc, placements, qr, timings: dict = None, save_options: dict = None
+) -> bytes:
+    if timings is None:
+        timings = {}
+    with fitz.open() as doc:
+        t0 = time.perf_counter()
+        doc.insert_pdf(template_doc)
+        doc.set_metadata(template_doc.metadata)
+        t1 = time.perf_counter()
+        for page_no, rect in placements.items():
+            insert_qr(doc[page_no], rect, qr)
+        t2 = time.perf_counter()
+        data = doc.tobytes(**(save_options or {}))
+        timings["pdf_open"] = t1 - t0
+        timings["insert_qr"] = t2 - t1
+        timings["tobytes"] = time.perf_counter() - t2
+        return data
+
+
+# Общий макет для многостраничного вывода: страницы шаблона вставляются через
+# show_pdf_page и хранятся в out_doc по одному разу как Form XObject; каждая
+# ссылка добавляет свой комплект страниц, которые лишь ссылаются на них,
+# и QR на страницах из placements.
+def append_page_with_qr(out_doc, template_doc, placements, qr, timings: dict = None):
+    if timings is None:
+        timings = {}
+    timings["pdf_open"] = timings["insert_qr"] = 0.0
+    for page_no in range(template_doc.page_count):
+        t0 = time.perf_counter()
+        src_rect = template_doc[page_no].rect
+        page = out_doc.new_page(width=src_rect.width, height=src_rect.height)
+        page.show_pdf_page(page.rect, template_doc, page_no)
+        t1 = time.perf_counter()
+        if page_no in placements:
+            insert_qr(page, placements[page_no], qr)
+        timings["pdf_open"] += t1 - t0
+        timings["insert_qr"] += time.perf_counter() - t1
+
+
+# --- МНОГОПРОЦЕССНЫЙ РЕНДЕР ---
+# Пул один на всю сборку, сколько бы макетов в ней ни было. Шаблоны лежат во
+# временных файлах; рабочий процесс открывает шаблон при первой ссылке на
+# него и дальше только копирует его и рисует QR. Процессы запускаются через
+# spawn: fork многопоточного сервера Streamlit небезопасен.
+_worker_paths = {}
+_worker_templates = {}
+_worker_save_options = None
+
+
+def _init_render_worker(template_paths: dict, save_options=None):
+    global _worker_paths, _worker_save_options
+    _worker_paths = template_paths
+    _worker_save_options = save_options
+
+
+def _render_in_worker(key, placements, qr):
+    template_doc = _worker_templates.get(key)
+    if template_doc is None:
+        template_doc = _worker_templates[key] = fitz.open(_worker_paths[key])
+    timings = {}
+    data = render_page_with_qr(
+        template_doc,
+        {n: fitz.Rect(r) for n, r in placements.items()},
+        qr,
+        timings,
+        _worker_save_options,
+    )
+    return data, timings
+
+
+# Время этапов рендера ссылки — в общие этапы и в её запись trace из
+# stats["links"].
+def _record_render(stats, trace, timings: dict, data: bytes):
+    if stats is None:
+        return
+    for stage, sec in timings.items():
+        add_stage(stats, stage, sec, len(data) if stage == "tobytes" else 0)
+    if trace is not None:
+        with stats["lock"]:
+            trace["render_s"] = round(sum(timings.values()), 4)
+            trace["pdf_bytes"] = len(data)
+
+
+# Рендер по нескольким макетам сразу. templates — {ключ: байты PDF}, items —
+# тройки (ключ шаблона, placements, qr) или четвёрки с записью trace из
+# iter_qr_payloads. Отдаёт пары (pdf_bytes, ошибка) строго в порядке items:
+# (None, None) — пустой QR, (None, исключение) — сбой рендера этой ссылки.
+# Шаблоны открываются по первому требованию. При workers > 1 в работе
+# держится не больше 2 * workers ссылок, поэтому память не растёт с партией.
+def iter_rendered_items(
+    templates: dict,
+    items,
+    workers: int = 1,
+    stats: dict = None,
+    save_options: dict = None,
+):
+    if workers <= 1:
+        docs = {}
+        try:
+            for key, placements, qr, *trace in items:
+                if qr is None:
+                    yield None, None
+                    continue
+                try:
+                    if key not in docs:
+                        docs[key] = fitz.open(stream=templates[key], filetype="pdf")
+                    timings = {}
+                    data = render_page_with_qr(
+                        docs[key], placements, qr, timings, save_options
+                    )
+                except Exception as e:
+                    yield None, e
+                    continue
+                _record_render(stats, trace[0] if trace else None, timings, data)
+                yield data, None
+        finally:
+            for doc in docs.values():
+                doc.close()
+        return
+
+    template_paths = {}
+    try:
+        for key, pdf_bytes in templates.items():
+            fd, template_paths[key] = tempfile.mkstemp(suffix=".pdf")
+            with os.fdopen(fd, "wb") as f:
+                f.write(pdf_bytes)
+
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_render_worker,
+            initargs=(template_paths, save_options),
+        )
+        window = deque()
+
+        def _result(item):
+            fut, trace = item
+            if fut is None:
+                return None, None
+            if isinstance(fut, Exception):
+                return None, fut
+            try:
+                data, timings = fut.result()
+            except Exception as e:
+                return None, e
+            _record_render(stats, trace, timings, data)
+            return data, None
+
+        try:
+            for key, placements, qr, *trace in items:
+                trace = trace[0] if trace else None
+                if qr is None:
+                    window.append((None, trace))
+                else:
+                    try:
+                        plain = {n: tuple(r) for n, r in placements.items()}
+                        fut = pool.submit(_render_in_worker, key, plain, qr)
+                        window.append((fut, trace))
+                    except Exception as e:
+                        window.append((e, trace))
+                if len(window) >= 2 * workers:
+                    yield _result(window.popleft())
+            while window:
+                yield _result(window.popleft())
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+    finally:
+        for path in template_paths.values():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# Рендер страниц одного макета по готовым QR (payloads — в порядке ссылок),
+# см. iter_rendered_items. Со stats время этапов рендера k-й ссылки
+# добавляется к записи traces[k] — списка, который заполнил iter_qr_payloads,
+# отдавший эти payloads.
+def iter_rendered_pages(
+    pdf_bytes: bytes,
+    placements,
+    payloads,
+    workers: int = 1,
+    stats: dict = None,
+    save_options: dict = None,
+    traces: list = None,
+):
+    def items():
+        for k, qr in enumerate(payloads):
+            trace = traces[k] if traces is not None and k < len(traces) else None
+            yield "", placements, qr, trace
+
+    return iter_rendered_items(
+        {"": pdf_bytes}, items(), workers, stats=stats, save_options=save_options
+    )
+
+
+# --- ФАЙЛЫ РЕЗУЛЬТАТОВ ---
+# Архив пишется сразу на диск, а не в память. Временный файл удаляется, как
+# только на него не остаётся ссылок (закончилась сессия, новый запуск);
+# файлы, брошенные упавшим процессом, убирает sweep_stale_results. Файлы
+# задач, которые ещё числятся в JOBS, не трогаются, сколько бы им ни было
+# лет: их удаляет forget_job.
+def open_result_file(suffix: str):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=RESULTS_DIR, suffix=suffix)
+
+
+def sweep_stale_results(max_age_s: float = RESULTS_TTL_S):
+    cutoff = time.time() - max_age_s
+    with _jobs_lock:
+        owned = {job["result_path"] for job in JOBS.values()}
+    for folder in (RESULTS_DIR, BUILDS_DIR):
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(folder, name)
+            if path in owned:
+                continue
+            try:
+                if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+# Текст для интерфейса и HTTP, когда файл результата уже удалён по сроку.
+RESULT_EXPIRED = "Результат устарел и удалён — соберите архив заново"
+
+
+def read_result_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# Один файл из архива, который, возможно, ещё пишется: центрального каталога
+# пока нет, поэтому файл читается по локальному заголовку. entry — запись
+# из on_entry в process_files.
+def read_zip_entry(path: str, entry: dict) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(entry["offset"])
+        header = f.read(30)
+        if header[:4] != b"PK\x03\x04":
+            raise ValueError(f"Нет заголовка файла {entry['name']} в архиве")
+        method = struct.unpack_from("<H", header, 8)[0]
+        name_len, extra_len = struct.unpack_from("<HH", header, 26)
+        f.seek(entry["offset"] + 30 + name_len + extra_len)
+        data = f.read(entry["end"] - f.tell())
+    if method == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(data, -15)
+    return data
+
+
+# compresslevel 0 — без сжатия (ZIP_STORED), 1–9 — deflate.
+def open_zip_writer(fileobj, compresslevel: int = 0):
+    if compresslevel:
+        return zipfile.ZipFile(
+            fileobj, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel
+        )
+    return zipfile.ZipFile(fileobj, "w")
+
+
+# --- ЧТЕНИЕ ССЫЛОК ИЗ EXCEL ---
+# Книга читается в режиме read_only: колонка со ссылками выбирается по первым
+# LINK_SAMPLE_ROWS строкам, затем потоком читается только она.
+LINK_SAMPLE_ROWS = 500
+_REL_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+
+
+# Колонки места QR и варианта макета рядом со ссылками (см. process_campaign)
+# узнаются по заголовку первой строки. Имена нарочно с «qr»: обычные «Size»,
+# «Page», «X» или «Layout» в таблице партнёра к QR отношения не имеют. Регистр,
+# пробелы, знаки и единицы «мм»/«mm» не важны — «qr_x_mm» и «QR X, мм»
+# равнозначны.
+PLACEMENT_COLUMNS = {
+    "layout": ("qrlayout", "макетqr"),
+    "x_mm": ("qrx",),
+    "y_mm": ("qry",),
+    "size_mm": ("qrsize", "размерqr"),
+    "pages": ("qrpages", "страницыqr"),
+}
+
+
+def _placement_columns(header, link_col: int) -> dict:
+    cols = {}
+    for col_idx, val in enumerate(header, start=1):
+        if col_idx == link_col or val is None:
+            continue
+        norm = re.sub(r"[^a-zа-яё0-9]", "", str(val).lower())
+        norm = re.sub(r"(мм|mm)$", "", norm)
+        for field, names in PLACEMENT_COLUMNS.items():
+            if norm in names:
+                cols.setdefault(field, col_idx)
+    return cols
+
+
+def is_url_like(s: str) -> bool:
+    s = s.strip()
+    if len(s) <= 5:
+        return False
+    return bool(re.search(r"http|www|\.[a-zA-Z]{2,}", s))
+
+
+# read_only не связывает гиперссылки с ячейками, поэтому адреса берём сами:
+# <hyperlinks> из XML листа (разбор потоком, строки данных сразу
+# выбрасываются) и цели из его .rels. Результат: {(строка, колонка): url}.
+def _sheet_hyperlinks(file_bytes: bytes, sheet_path: str) -> dict:
+    links = {}
+    if not sheet_path:
+        return links
+    sheet_path = sheet_path.lstrip("/")
+    rels_path = posixpath.join(
+        posixpath.dirname(sheet_path), "_rels", posixpath.basename(sheet_path) + ".rels"
+    )
+
+    with zipfile.ZipFile(io.BytesIO(file_bytes)) as zf:
+        try:
+            rels = ET.fromstring(zf.read(rels_path))
+        except KeyError:
+            return links
+        targets = {rel.get("Id"): rel.get("Target") for rel in rels}
+
+        sheet_data = None
+        with zf.open(sheet_path) as src:
+            for event, elem in ET.iterparse(src, events=("start", "end")):
+                tag = elem.tag.rsplit("}", 1)[-1]
+                if event == "start":
+                    if tag == "sheetData":
+                        sheet_data = elem
+                    continue
+                if tag == "row" and sheet_data is not None:
+                    sheet_data.clear()
+                elif tag == "hyperlink":
+                    target = targets.get(elem.get(_REL_ID))
+                    ref = elem.get("ref")
+                    if not target or not ref:
+                        continue
+                    min_col, min_row, max_col, max_row = range_boundaries(ref)
+                    for r in range(min_row, max_row + 1):
+                        for c in range(min_col, max_col + 1):
+                            links[(r, c)] = target
+
+    return links
+
+
+def extract_links_from_excel(file) -> list:
+    return [row["link"] for row in extract_link_rows_from_excel(file)]
+
+
+# Строки {"link": …} с полями из PLACEMENT_COLUMNS, если такие колонки есть.
+def extract_link_rows_from_excel(file) -> list:
+    file_bytes = file.read()
+
+    wb = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        ws.reset_dimensions()
+        hyperlinks = _sheet_hyperlinks(file_bytes, getattr(ws, "_worksheet_path", None))
+
+        def cell_text(row_idx, col_idx, val):
+            target = hyperlinks.get((row_idx, col_idx))
+            if target:
+                return str(target).strip()
+            return "" if val is None else str(val).strip()
+
+        scores = {}
+        row_lens = {}
+        header = ()
+        sample = ws.iter_rows(min_row=1, max_row=LINK_SAMPLE_ROWS, values_only=True)
+        for row_idx, row in enumerate(sample, start=1):
+            if row_idx == 1:
+                header = row
+            row_lens[row_idx] = len(row)
+            for col_idx, val in enumerate(row, start=1):
+                if is_url_like(cell_text(row_idx, col_idx, val)):
+                    scores[col_idx] = scores.get(col_idx, 0) + 1
+        # Гиперссылки в пустых ячейках за концом строки в выборку не попали.
+        for (row_idx, col_idx), target in hyperlinks.items():
+            if (
+                row_idx <= LINK_SAMPLE_ROWS
+                and col_idx > row_lens.get(row_idx, 0)
+                and is_url_like(target)
+            ):
+                scores[col_idx] = scores.get(col_idx, 0) + 1
+
+        if not scores:
+            return []
+        best_col = _best_column(scores)
+        extra_cols = _placement_columns(header, best_col)
+
+        first = min([best_col, *extra_cols.values()])
+        last = max([best_col, *extra_cols.values()])
+        table = ws.iter_rows(min_row=1, min_col=first, max_col=last, values_only=True)
+        col_vals = []
+        extra = {field: [] for field in extra_cols}
+        for row_idx, row in enumerate(table, start=1):
+            row = row + (None,) * (last - first + 1 - len(row))
+            col_vals.append(cell_text(row_idx, best_col, row[best_col - first]))
+            for field, col_idx in extra_cols.items():
+                extra[field].append(row[col_idx - first])
+    finally:
+        wb.close()
+
+    return _clean_link_rows(col_vals, extra)
+
+
+def _best_column(scores: dict) -> int:
+    return min(scores, key=lambda c: (-scores[c], c))
+
+
+# Первое значение колонки, не похожее на ссылку, считается заголовком.
+# extra — {поле: значения по тем же строкам}; пустые значения не попадают
+# в строку, числа из Excel остаются числами.
+def _clean_link_rows(col_vals, extra=None) -> list:
+    start = 1 if col_vals and not is_url_like(col_vals[0]) else 0
+
+    rows = []
+    for j in range(start, len(col_vals)):
+        v = col_vals[j]
+        if not v or not v.strip() or v.strip().lower() in ("nan", "none"):
+            continue
+        row = {"link": v.strip()}
+        for field, vals in (extra or {}).items():
+            val = vals[j] if j < len(vals) else None
+            if isinstance(val, str):
+                val = val.strip()
+            if val is not None and val != "":
+                row[field] = val
+        rows.append(row)
+
+    return rows
+
+
+# --- ЧТЕНИЕ ССЫЛОК ИЗ CSV / TSV / TXT ---
+# Файл читается потоком (в т.ч. .gz): колонка выбирается по выборке строк,
+# как в Excel, затем второй проход берёт только её. В .txt — ссылка на строку.
+TEXT_SAMPLE_BYTES = 64 * 1024
+TEXT_LINK_TYPES = ["csv", "tsv", "txt", "gz"]
+
+
+def _open_binary(file):
+    file.seek(0)
+    magic = file.read(2)
+    file.seek(0)
+    if magic == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=file, mode="rb")
+    return file
+
+
+def _text_encoding(sample: bytes) -> str:
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "cp1251"
+
+
+def _iter_text_rows(file, encoding: str, delimiter):
+    binary = _open_binary(file)
+    text = io.TextIOWrapper(binary, encoding=encoding, errors="replace", newline="")
+    try:
+        if delimiter is None:
+            for line in text:
+                yield [line.strip()]
+        else:
+            for row in csv.reader(text, delimiter=delimiter):
+                yield [v.strip() for v in row]
+    finally:
+        text.detach()
+
+
+def extract_links_from_text_file(file, name: str = "") -> list:
+    return [row["link"] for row in extract_link_rows_from_text_file(file, name)]
+
+
+def extract_link_rows_from_text_file(file, name: str = "") -> list:
+    name = name.lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+
+    sample = _open_binary(file).read(TEXT_SAMPLE_BYTES)
+    encoding = _text_encoding(sample)
+
+    if name.endswith(".txt"):
+        delimiter = None
+    elif name.endswith(".tsv"):
+        delimiter = "\t"
+    else:
+        sample_text = sample.decode(encoding, errors="ignore")
+        try:
+            delimiter = csv.Sniffer().sniff(sample_text, delimiters=",;\t|").delimiter
+        except csv.Error:
+            delimiter = ","
+
+    scores = {}
+    header = []
+    rows = _iter_text_rows(file, encoding, delimiter)
+    for row_idx, row in enumerate(rows, start=1):
+        if row_idx > LINK_SAMPLE_ROWS:
+            break
+        if row_idx == 1:
+            header = row
+        for col_idx, val in enumerate(row, start=1):
+            if is_url_like(val):
+                scores[col_idx] = scores.get(col_idx, 0) + 1
+    rows.close()
+
+    if not scores:
+        return []
+    best_col = _best_column(scores)
+    extra_cols = _placement_columns(header, best_col)
+
+    col_vals = []
+    extra = {field: [] for field in extra_cols}
+    for row in _iter_text_rows(file, encoding, delimiter):
+        col_vals.append(row[best_col - 1] if len(row) >= best_col else "")
+        for field, col_idx in extra_cols.items():
+            extra[field].append(row[col_idx - 1] if len(row) >= col_idx else "")
+    return _clean_link_rows(col_vals, extra)
+
+
+# --- ДУБЛИ ССЫЛОК ---
+# Хеш-индекс: уникальные ссылки в порядке первого появления и для каждой
+# позиции входного списка — номер её уникальной ссылки.
+def index_links(links):
+    positions = {}
+    unique = []
+    index = []
+    for link in links:
+        key = str(link).strip()
+        pos = positions.get(key)
+        if pos is None:
+            pos = positions[key] = len(unique)
+            unique.append(link)
+        index.append(pos)
+    return unique, index
+
+
+# Разворачивает результаты по уникальным ссылкам обратно на все позиции.
+# Результат держится в памяти только до последнего повтора своей ссылки.
+def expand_duplicates(results, index):
+    last_use = {}
+    for i, u in enumerate(index):
+        last_use[u] = i
+
+    results = iter(results)
+    held = {}
+    next_unique = 0
+    for i, u in enumerate(index):
+        if u == next_unique:
+            value = next(results)
+            next_unique += 1
+            if last_use[u] > i:
+                held[u] = value
+        else:
+            value = held[u]
+            if last_use[u] == i:
+                del held[u]
+        yield value
+
+
+# --- МАНИФЕСТ СБОРКИ ---
+# Для каждого файла архива запоминается ключ его содержимого: хеш макета,
+# место QR, параметры QR и сама ссылка (имя файла в ключ не входит).
+# Манифест последней сборки макета лежит в BUILDS_DIR и указывает на её
+# архив; при повторной сборке файлы с тем же ключом берутся из старого
+# архива без рендера, даже если поменялись имя партнёра или номер.
+def build_entry_key(
+    digest: str, placements, vector, policy, plan, link, profile="fast"
+) -> str:
+    params = {
+        "v": 1,
+        "pdf": digest,
+        "placements": [
+            [n, [round(v, 3) for v in tuple(placements[n])]] for n in sorted(placements)
+        ],
+        "vector": vector,
+        "policy": policy,
+        "qr": list(plan) if plan else None,
+        "profile": profile,
+        "link": _clean_link(link),
+    }
+    raw = json.dumps(params, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _build_manifest_path(digest: str) -> str:
+    return os.path.join(BUILDS_DIR, digest + ".json")
+
+
+def load_build_manifest(digest: str):
+    try:
+        with open(_build_manifest_path(digest), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not zipfile.is_zipfile(manifest.get("archive", "")):
+        return None
+    return manifest
+
+
+def save_build_manifest(digest: str, archive_path: str, entries: dict):
+    data = {"archive": archive_path, "entries": entries, "created": time.time()}
+    try:
+        os.makedirs(BUILDS_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=BUILDS_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, _build_manifest_path(digest))
+    except OSError:
+        pass
+
+
+# Отрендеренные файлы вперемешку с файлами из прежних архивов, в порядке
+# заданий; reuse — для каждого задания (old_zip, имя в нём) или None, если
+# задание рендерится.
+def _merge_reused(rendered, reuse):
+    rendered = iter(rendered)
+    for item in reuse:
+        if item is None:
+            yield next(rendered)
+            continue
+        old_zip, name = item
+        try:
+            yield old_zip.read(name), None
+        except Exception as e:
+            yield None, e
+
+
+# --- КАМПАНИИ: НЕСКОЛЬКО МАКЕТОВ И МЕСТ QR ---
+# Строка списка может выбрать свой макет (колонка qr_layout — имя файла
+# варианта, с .pdf или без) и своё место QR: любая из колонок qr_x_mm,
+# qr_y_mm, qr_size_mm переводит её на ручные координаты, недостающие
+# берутся из общих настроек; qr_pages — свои страницы. В строке это поля
+# layout, x_mm, y_mm, size_mm и pages (см. PLACEMENT_COLUMNS). Строки с
+# одинаковыми (макет, место, страницы) образуют группу: её шаблон
+# разбирается и анализируется один раз, ссылки рендерятся подряд.
+def _layout_names(layouts) -> dict:
+    names = {}
+    for name in layouts:
+        key = name.strip().lower()
+        names.setdefault(key, name)
+        if key.endswith(".pdf"):
+            names.setdefault(key[:-4], name)
+    return names
+
+
+def _row_mm(row, field: str, default: float) -> float:
+    val = row.get(field)
+    if val is None:
+        return default
+    try:
+        return float(str(val).replace(",", ".").strip())
+    except ValueError:
+        raise ValueError(f"неверное значение {field}: {val}") from None
+
+
+def _row_group(row, names, default_layout, mode, x_mm, y_mm, size_mm, pages):
+    layout = default_layout
+    if row.get("layout") is not None:
+        layout = names.get(str(row["layout"]).strip().lower())
+        if layout is None:
+            raise ValueError(f"нет макета «{row['layout']}»")
+
+    coords = None
+    if mode == "manual" or any(f in row for f in ("x_mm", "y_mm", "size_mm")):
+        coords = (
+            _row_mm(row, "x_mm", x_mm),
+            _row_mm(row, "y_mm", y_mm),
+            _row_mm(row, "size_mm", size_mm),
+        )
+        if coords[2] <= 0:
+            raise ValueError("не задан размер QR (size_mm)")
+
+    if row.get("pages") is not None:
+        pages = str(row["pages"]).strip()
+    return layout, coords, pages
+
+
+def _group_label(key) -> str:
+    layout, coords, pages = key
+    label = f"Макет {layout}" if layout else "Макет"
+    if coords:
+        label += ", x {:g} y {:g} размер {:g} мм".format(*coords)
+    return f"{label}, стр. {pages}"
+
+
+# --- ОБРАБОТКА PDF И ГЕНЕРАЦИЯ ZIP ---
+def _no_progress(done, total, text):
+    pass
+
+
+# Весь конвейер одним вызовом, без интерфейса. layouts — {имя: байты PDF},
+# первый макет — основной; rows — строки списка ({"link", ...} из
+# extract_link_rows_*). progress(done, total, text) вызывается перед стартом
+# и после каждой ссылки. Результат пишется в result_file (любой бинарный
+# файл) или во временный файл в RESULTS_DIR. Возвращает (файл, ошибки);
+# файл None, если не получилось ни одного QR.
+# Если выставлен cancel (threading.Event), обработка прерывается после
+# текущей ссылки, а недописанный файл закрывается. С incremental архив
+# собирается с учётом манифестов прошлых сборок тех же макетов; archive_path —
+# где архив окажется в итоге, если result_file потом переименуют.
+# output_profile — ключ OUTPUT_PROFILES, как сохранять каждый PDF.
+# on_entry({"name", "index", "offset", "end"}) вызывается после каждого файла,
+# дописанного в архив: до end байты result_file уже не меняются, и файл
+# можно отдавать (read_zip_entry, iter_job_result), не дожидаясь конца.
+# Имя файла — партнёр, размер (или имя варианта макета) и номер строки.
+def process_campaign(
+    layouts: dict,
+    rows,
+    p_name,
+    p_size,
+    mode,
+    x_mm,
+    y_mm,
+    size_mm,
+    raster_dpi=72,
+    refine_dpi=None,
+    detect_timings=None,
+    output="zip",
+    qr_vector=True,
+    fetch_workers=FETCH_WORKERS,
+    fetch_per_host=FETCH_PER_HOST,
+    fetch_deadline_s=FETCH_DEADLINE_S,
+    link_policy="auto",
+    qr_cache=True,
+    render_workers=1,
+    zip_compression=0,
+    dedupe=True,
+    page_selection="1",
+    layout_cache=True,
+    qr_uniform=True,
+    progress=None,
+    result_file=None,
+    cancel=None,
+    incremental=True,
+    archive_path=None,
+    stats=None,
+    output_profile="fast",
+    on_entry=None,
+):
+    success_count = 0
+    total_links = len(rows)
+    errors_log = []
+    if detect_timings is None:
+        detect_timings = {}
+    add_counter(stats, "links", total_links)
+    add_counter(stats, "input_pdf_bytes", sum(len(b) for b in layouts.values()))
+    save_options = OUTPUT_PROFILES[output_profile]
+    if stats is not None:
+        stats["output_profile"] = output_profile
+
+    default_layout = next(iter(layouts))
+    names = _layout_names(layouts)
+    groups = {}
+    for i, row in enumerate(rows, start=1):
+        try:
+            key = _row_group(
+                row, names, default_layout, mode, x_mm, y_mm, size_mm, page_selection
+            )
+        except ValueError as e:
+            errors_log.append(f"Ссылка №{i}: {e}")
+            continue
+        groups.setdefault(key, []).append(i)
+    add_counter(stats, "groups", len(groups))
+
+    # Место QR ищется один раз на группу; в ошибках и замерах групп больше
+    # одной — подпись группы.
+    t0 = time.perf_counter()
+    placed = []
+    for key, numbers in groups.items():
+        layout, coords, pages = key
+        prefix = f"{_group_label(key)}: " if len(groups) > 1 else ""
+        timings = {}
+        placements, errs = resolve_qr_rects(
+            layouts[layout],
+            pages,
+            "manual" if coords else mode,
+            *(coords or (x_mm, y_mm, size_mm)),
+            raster_dpi=raster_dpi,
+            refine_dpi=refine_dpi,
+            detect_timings=timings,
+            layout_cache=layout_cache,
+        )
+        for level, sec in timings.items():
+            detect_timings[f"{prefix}{level}"] = sec
+        errors_log.extend(f"{prefix}{err}" for err in errs)
+        if placements:
+            placed.append((key, placements, numbers))
+        elif prefix:
+            errors_log.append(f"{prefix}пропущено ссылок: {len(numbers)}")
+    add_stage(stats, "detect", time.perf_counter() - t0)
+    if stats is not None:
+        stats["detect"] = detect_timings
+    if not placed:
+        return None, errors_log
+
+    if progress is None:
+        progress = _no_progress
+    progress(0, total_links, "Начинаем обработку...")
+    if result_file is None:
+        sweep_stale_results()
+        result_file = open_result_file(".pdf" if output == "pdf" else ".zip")
+
+    # Версия QR — одна на всю кампанию, по всем её ссылкам.
+    plan = None
+    if qr_uniform and link_policy != "fetch":
+        t0 = time.perf_counter()
+        plan = plan_qr_batch(
+            index_links(
+                [rows[i - 1]["link"] for _, _, numbers in placed for i in numbers]
+            )[0]
+        )
+        add_stage(stats, "qr_plan", time.perf_counter() - t0)
+
+    # Срок на сеть — один на всю кампанию, а не на каждую группу.
+    stop_at = time.monotonic() + fetch_deadline_s if fetch_deadline_s else None
+
+    def cancelled():
+        return cancel is not None and cancel.is_set()
+
+    # Вся кампания — один поток QR (один пул потоков и одна HTTP-сессия) и
+    # для ZIP один пул рендера, сколько бы групп в ней ни было. Строки идут
+    # в порядке входа, каждая со своим макетом и местом QR; шаблоны
+    # различаются хешем, поэтому один файл под разными именами открывается
+    # один раз.
+    group_of = {i: g for g, (_, _, numbers) in enumerate(placed) for i in numbers}
+    order = sorted(group_of)
+    digests = [pdf_digest(layouts[key[0]]) for key, _, _ in placed]
+    templates = {digests[g]: layouts[key[0]] for g, (key, _, _) in enumerate(placed)}
+
+    # Пары (qr, запись из stats["links"]) для всех позиций link_index.
+    def iter_payloads(unique_links, link_index):
+        traces = []
+        fetched = iter_qr_payloads(
+            unique_links,
+            vector=qr_vector,
+            workers=fetch_workers,
+            per_host=fetch_per_host,
+            policy=link_policy,
+            cache=qr_cache,
+            uniform=qr_uniform,
+            plan=plan,
+            stats=stats,
+            stop_at=stop_at,
+            traces=traces,
+        )
+        with closing(fetched):
+            payloads = fetched
+            if link_index is not None:
+                payloads = expand_duplicates(fetched, link_index)
+            for k, qr in enumerate(payloads):
+                yield qr, traces[link_index[k] if link_index is not None else k]
+
+    done = 0
+    if output == "pdf":
+        links = [rows[i - 1]["link"] for i in order]
+        unique_links, link_index = index_links(links) if dedupe else (links, None)
+        add_counter(stats, "unique_links", len(unique_links))
+        payloads = iter_payloads(unique_links, link_index)
+
+        metadata = None
+        docs = {}
+        try:
+            with fitz.open() as out_doc, closing(payloads):
+                for i in order:
+                    if cancelled():
+                        break
+                    qr, _ = next(payloads)
+                    done += 1
+                    progress(done, total_links, f"Обработка {done} из {total_links}")
+                    g = group_of[i]
+                    try:
+                        if digests[g] not in docs:
+                            docs[digests[g]] = fitz.open(
+                                stream=templates[digests[g]], filetype="pdf"
+                            )
+                        template_doc = docs[digests[g]]
+                        if metadata is None:
+                            metadata = template_doc.metadata
+                        if qr is not None:
+                            timings = {}
+                            append_page_with_qr(
+                                out_doc, template_doc, placed[g][1], qr, timings
+                            )
+                            for stage, sec in timings.items():
+                                add_stage(stats, stage, sec)
+                            success_count += 1
+                        else:
+                            errors_log.append(
+                                f"Ссылка №{i}: Пустые данные или сбой при создании QR"
+                            )
+                    except Exception as e:
+                        errors_log.append(f"Ссылка №{i}: Ошибка {e}")
+
+                if success_count and not cancelled():
+                    out_doc.set_metadata(metadata)
+                    t0 = time.perf_counter()
+                    data = out_doc.tobytes(**save_options)
+                    add_stage(stats, "tobytes", time.perf_counter() - t0, len(data))
+                    result_file.write(data)
+        finally:
+            for doc in docs.values():
+                doc.close()
+    else:
+        labels = []
+        for key, _, _ in placed:
+            label = p_size if key[0] == default_layout else key[0]
+            labels.append(label[:-4] if label.lower().endswith(".pdf") else label)
+
+        # Манифест — по одному на макет; группы одного макета с разными
+        # местами QR делят его, записи различаются ключами. Задание — один
+        # файл архива с уникальным ключом записи: строки с тем же ключом
+        # получают его копию. Задание берётся из прошлой сборки (reuse —
+        # (old_zip, имя)) или рендерится.
+        manifests = {}
+        manifest_entries = {}
+        old_zips = {}
+        old_names = {}
+        jobs = []
+        job_index = {}
+        row_jobs = []
+        payloads = None
+        try:
+            for i in order:
+                g = group_of[i]
+                link = rows[i - 1]["link"]
+                entry_key = build_entry_key(
+                    digests[g],
+                    placed[g][1],
+                    qr_vector,
+                    link_policy,
+                    plan,
+                    link,
+                    output_profile,
+                )
+                j = job_index.get(entry_key) if dedupe else None
+                if j is None:
+                    j = job_index[entry_key] = len(jobs)
+                    reuse = None
+                    if digests[g] not in manifests:
+                        manifests[digests[g]] = (
+                            load_build_manifest(digests[g]) if incremental else None
+                        )
+                    manifest = manifests[digests[g]]
+                    if manifest is not None:
+                        path = manifest["archive"]
+                        if path not in old_zips:
+                            old_zips[path] = zipfile.ZipFile(path)
+                            old_names[path] = set(old_zips[path].namelist())
+                        name = manifest["entries"].get(entry_key)
+                        if name in old_names[path]:
+                            reuse = (old_zips[path], name)
+                    jobs.append((g, link, entry_key, reuse))
+                row_jobs.append(j)
+
+            reused = sum(job[3] is not None for job in jobs)
+            add_counter(stats, "unique_links", len(jobs))
+            add_counter(stats, "reused_entries", reused)
+            if reused:
+                progress(
+                    done,
+                    total_links,
+                    f"Без изменений {reused} из {len(jobs)}, собираем остальные...",
+                )
+
+            fresh = [job for job in jobs if job[3] is None]
+            links = [link for _, link, _, _ in fresh]
+            payloads = iter_payloads(
+                *(index_links(links) if dedupe else (links, None))
+            )
+            pages = iter_rendered_items(
+                templates,
+                (
+                    (digests[g], placed[g][1], qr, trace)
+                    for (g, _, _, _), (qr, trace) in zip(fresh, payloads)
+                ),
+                workers=render_workers,
+                stats=stats,
+                save_options=save_options,
+            )
+            results = _merge_reused(pages, [job[3] for job in jobs])
+            if dedupe:
+                results = expand_duplicates(results, row_jobs)
+
+            with open_zip_writer(result_file, zip_compression) as zf, closing(pages):
+                for i, j in zip(order, row_jobs):
+                    if cancelled():
+                        break
+                    pdf_out, err = next(results)
+                    g, _, entry_key, _ = jobs[j]
+                    done += 1
+                    progress(done, total_links, f"Обработка {done} из {total_links}")
+                    if pdf_out:
+                        filename = f"{p_name}_{labels[g]}_{i:02d}.pdf"
+                        t0 = time.perf_counter()
+                        zf.writestr(filename, pdf_out)
+                        add_stage(
+                            stats,
+                            "zip_write",
+                            time.perf_counter() - t0,
+                            len(pdf_out),
+                        )
+                        success_count += 1
+                        entries = manifest_entries.setdefault(digests[g], {})
+                        entries.setdefault(entry_key, filename)
+                        if on_entry is not None:
+                            result_file.flush()
+                            on_entry(
+                                {
+                                    "name": filename,
+                                    "index": i,
+                                    "offset": zf.getinfo(filename).header_offset,
+                                    "end": result_file.tell(),
+                                }
+                            )
+                    elif err is None:
+                        errors_log.append(
+                            f"Ссылка №{i}: Пустые данные или сбой при создании QR"
+                        )
+                    else:
+                        errors_log.append(f"Ссылка №{i}: Ошибка {err}")
+        finally:
+            if payloads is not None:
+                payloads.close()
+            for old_zip in old_zips.values():
+                old_zip.close()
+
+        result_path = archive_path or getattr(result_file, "name", None)
+        if success_count and isinstance(result_path, str) and not cancelled():
+            for digest, entries in manifest_entries.items():
+                save_build_manifest(digest, os.path.abspath(result_path), entries)
+
+    if cancelled():
+        result_file.close()
+        errors_log.append("Обработка отменена")
+        return None, errors_log
+    if success_count == 0:
+        result_file.close()
+        return None, errors_log
+    result_file.flush()
+    add_counter(stats, "output_bytes", result_file.tell())
+    add_counter(stats, "errors", len(errors_log))
+    result_file.seek(0)
+    return result_file, errors_log
+
+
+# Один макет и одно место QR для всех ссылок — кампания из одной группы.
+def process_files(
+    pdf_file,
+    links,
+    p_name,
+    p_size,
+    mode,
+    x_mm,
+    y_mm,
+    size_mm,
+    *args,
+    **kwargs,
+):
+    if isinstance(pdf_file, (bytes, bytearray)):
+        pdf_bytes = bytes(pdf_file)
+    else:
+        pdf_file.seek(0)
+        pdf_bytes = pdf_file.read()
+    return process_campaign(
+        {"": pdf_bytes},
+        [{"link": link} for link in links],
+        p_name,
+        p_size,
+        mode,
+        x_mm,
+        y_mm,
+        size_mm,
+        *args,
+        **kwargs,
+    )
+
+
+# --- ФОНОВЫЕ ЗАДАЧИ ---
+# Генерация идёт в отдельном потоке, интерфейс только опрашивает состояние.
+# Реестр общий для всех сессий процесса: одновременно выполняется не больше
+# JOB_MAX_RUNNING задач, остальные ждут в статусе queued. Готовый файл
+# хранится в задаче по её id, пока задачу не забудут или не истечёт
+# RESULTS_TTL_S: раз в RESULTS_SWEEP_EVERY_S фоновый поток убирает старые
+# задачи и файлы, даже если новых задач нет. Пока архив собирается, в
+# entries копятся записи о уже дописанных файлах, а result_path указывает
+# на сам растущий архив.
+JOB_MAX_RUNNING = int(os.environ.get("JOB_MAX_RUNNING", 2))
+JOBS = {}
+_jobs_lock = threading.Lock()
+_job_slots = threading.BoundedSemaphore(max(1, JOB_MAX_RUNNING))
+_sweeper = None
+
+
+def submit_job(pdf_bytes: bytes, links, *args, **kwargs) -> str:
+    return submit_campaign(
+        {"": pdf_bytes}, [{"link": link} for link in links], *args, **kwargs
+    )
+
+
+# Задача по кампании: аргументы как у process_campaign.
+def submit_campaign(layouts: dict, rows, *args, **kwargs) -> str:
+    sweep_jobs()
+    _start_sweeper()
+    job_id = os.urandom(8).hex()
+    job = {
+        "id": job_id,
+        "status": "queued",
+        "done": 0,
+        "total": len(rows),
+        "text": "В очереди...",
+        "errors": [],
+        "result": None,
+        "result_path": None,
+        "entries": [],
+        "detect_timings": {},
+        "cache_delta": {},
+        "stats": new_run_stats(),
+        "report": None,
+        "created": time.time(),
+        "finished": None,
+        "cancel": threading.Event(),
+    }
+    with _jobs_lock:
+        JOBS[job_id] = job
+    threading.Thread(
+        target=_run_job,
+        args=(job, layouts, rows, args, kwargs),
+        name=f"job-{job_id}",
+        daemon=True,
+    ).start()
+    return job_id
+
+
+def _run_job(job, layouts, rows, args, kwargs):
+    while not _job_slots.acquire(timeout=0.5):
+        if job["cancel"].is_set():
+            job.update(status="cancelled", finished=time.time())
+            return
+
+    def progress(done, total, text):
+        job.update(done=done, total=total, text=text)
+
+    try:
+        if job["cancel"].is_set():
+            job.update(status="cancelled")
+            return
+        job["status"] = "running"
+        sweep_stale_results()
+        result_file = open_result_file(
+            ".pdf" if kwargs.get("output") == "pdf" else ".zip"
+        )
+        job["result_path"] = result_file.name
+        cache_before = qr_cache_stats()
+        res, errors = process_campaign(
+            layouts,
+            rows,
+            *args,
+            detect_timings=job["detect_timings"],
+            progress=progress,
+            result_file=result_file,
+            cancel=job["cancel"],
+            stats=job["stats"],
+            on_entry=job["entries"].append,
+            **kwargs,
+        )
+        cache_after = qr_cache_stats()
+        job["cache_delta"] = {k: cache_after[k] - cache_before[k] for k in cache_after}
+        job["errors"] = errors
+        job["result"] = res
+        if res is not None:
+            job["status"] = "done"
+        elif job["cancel"].is_set():
+            job["status"] = "cancelled"
+        else:
+            job["status"] = "failed"
+    except Exception as e:
+        job["errors"].append(f"Ошибка: {e}")
+        job["status"] = "failed"
+    finally:
+        job["report"] = run_stats_report(job["stats"])
+        job["finished"] = time.time()
+        _job_slots.release()
+
+
+# Снимок состояния для интерфейса; None, если задачи нет (или уже удалена).
+def job_status(job_id: str):
+    with _jobs_lock:
+        job = JOBS.get(job_id)
+    if job is None:
+        return None
+    return {k: v for k, v in job.items() if k not in ("cancel", "stats")}
+
+
+def cancel_job(job_id: str):
+    with _jobs_lock:
+        job = JOBS.get(job_id)
+    if job is not None:
+        job["cancel"].set()
+
+
+def forget_job(job_id: str):
+    with _jobs_lock:
+        job = JOBS.pop(job_id, None)
+    if job is None:
+        return
+    job["cancel"].set()
+    if job["result"] is not None:
+        try:
+            job["result"].close()
+        except OSError:
+            pass
+
+
+def sweep_jobs(max_age_s: float = RESULTS_TTL_S):
+    cutoff = time.time() - max_age_s
+    with _jobs_lock:
+        stale = [
+            job_id
+            for job_id, job in JOBS.items()
+            if job["finished"] is not None and job["finished"] < cutoff
+        ]
+    for job_id in stale:
+        forget_job(job_id)
+
+
+def _sweep_loop():
+    while True:
+        time.sleep(RESULTS_SWEEP_EVERY_S)
+        try:
+            sweep_jobs()
+            sweep_stale_results()
+        except Exception:
+            pass
+
+
+def _start_sweeper():
+    global _sweeper
+    with _jobs_lock:
+        if _sweeper is not None:
+            return
+        _sweeper = threading.Thread(target=_sweep_loop, name="jobs-sweep", daemon=True)
+    _sweeper.start()
+
+
+# --- РАЗДАЧА РЕЗУЛЬТАТОВ ПО HTTP ---
+# Результат задачи кусками по мере готовности: пока задача идёт, отдаётся
+# только та часть архива, что уже не изменится (до конца последнего
+# дописанного файла), потом — остаток с центральным каталогом. Один PDF
+# пишется целиком в конце, его отдача просто ждёт завершения. Если задача
+# упала или отменена, а также если файл уже удалён по сроку, поток
+# обрывается с RuntimeError.
+def iter_job_result(job_id: str, chunk: int = RESULTS_HTTP_CHUNK, poll_s=0.25):
+    with _jobs_lock:
+        job = JOBS.get(job_id)
+    if job is None:
+        raise KeyError(job_id)
+    while job["result_path"] is None and job["status"] in ("queued", "running"):
+        time.sleep(poll_s)
+    if job["result_path"] is None:
+        raise RuntimeError("Задача не создала файл результата")
+
+    pos = 0
+    try:
+        f = open(job["result_path"], "rb")
+    except FileNotFoundError:
+        raise RuntimeError(RESULT_EXPIRED) from None
+    with f:
+        while True:
+            finished = job["status"] not in ("queued", "running")
+            if finished and job["status"] != "done":
+                raise RuntimeError("Задача не завершилась: " + job["status"])
+            size = chunk
+            if not finished:
+                entries = job["entries"]
+                size = min(chunk, (entries[-1]["end"] if entries else 0) - pos)
+            data = f.read(size) if size > 0 else b""
+            if data:
+                pos += len(data)
+                yield data
+            elif finished:
+                return
+            else:
+                time.sleep(poll_s)
+
+
+def job_result_url(job_id: str, name: str) -> str:
+    return f"{RESULTS_HTTP_URL}/jobs/{job_id}/result?name={quote(name)}"
+
+
+def job_file_url(job_id: str, index: int) -> str:
+    return f"{RESULTS_HTTP_URL}/jobs/{job_id}/files/{index}"
+
+
+# Готовый файл архива по номеру ссылки; None, если он ещё не дописан.
+def find_job_entry(job: dict, index: int):
+    for entry in reversed(job["entries"]):
+        if entry["index"] == index:
+            return entry
+    return None
+
+
+# Маленький HTTP-сервер рядом с интерфейсом: файлы отдаются с диска
+# кусками, не проходя через память Streamlit. Маршруты:
+#   /jobs/<id>/result?name=… — весь результат (chunked, по мере готовности);
+#   /jobs/<id>/files/<n>     — готовый файл архива для ссылки №n.
+# id задачи — случайные 64 бита, другой защиты нет: наружу порт открывают
+# только вместе с интерфейсом. None, если RESULTS_HTTP_PORT = 0.
+def start_results_server(
+    port: int = RESULTS_HTTP_PORT, host: str = RESULTS_HTTP_HOST
+):
+    if not port:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _attachment(self, ctype: str, name: str):
+            self.send_header("Content-Type", ctype)
+            self.send_header(
+                "Content-Disposition", f"attachment; filename*=UTF-8''{quote(name)}"
+            )
+
+        def _not_found(self, text: str, status: int = 404):
+            body = text.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            parts = url.path.strip("/").split("/")
+            job = None
+            if len(parts) >= 3 and parts[0] == "jobs":
+                job = job_status(parts[1])
+            if job is None:
+                return self._not_found("Задача не найдена")
+
+            if parts[2] == "files" and len(parts) == 4 and parts[3].isdigit():
+                entry = find_job_entry(job, int(parts[3]))
+                if entry is None:
+                    return self._not_found("Файл ещё не готов")
+                try:
+                    data = read_zip_entry(job["result_path"], entry)
+                except FileNotFoundError:
+                    return self._not_found(RESULT_EXPIRED, 410)
+                except (OSError, ValueError):
+                    return self._not_found("Файл недоступен")
+                self.send_response(200)
+                self._attachment("application/pdf", entry["name"])
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+
+            if parts[2] != "result" or len(parts) != 3:
+                return self._not_found("Неизвестный адрес")
+            if job["result_path"] and not os.path.exists(job["result_path"]):
+                return self._not_found(RESULT_EXPIRED, 410)
+            is_pdf = (job["result_path"] or "").endswith(".pdf")
+            name = parse_qs(url.query).get("name", [""])[0]
+            name = name or ("qrs.pdf" if is_pdf else "qrs.zip")
+            self.send_response(200)
+            self._attachment("application/pdf" if is_pdf else "application/zip", name)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for data in iter_job_result(parts[1]):
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            except (KeyError, RuntimeError):
+                # Без завершающего пустого куска браузер пометит загрузку
+                # как сбойную, а не сохранит обрезанный архив.
+                self.close_connection = True
+                return
+            self.wfile.write(b"0\r\n\r\n")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="results-http", daemon=True
+    ).start()
+    return server